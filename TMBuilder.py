@@ -2,6 +2,7 @@
 
 import tm
 import tmdb
+import tmevents
 import argparse
 
 framework = """
@@ -264,6 +265,189 @@ def subroutine(func):
 
 
 
+class RegisterProfile:
+    """Register level execution profile of the first limit register
+    operations of a run of the registers engine (see tmregmachine), by
+    segment: an operation and the run of the rest of the machine from its
+    return to the entry of the next one. Segments are grouped by node, the
+    path they take (entry state, final state, next entry state and the
+    states entered on the way), and by the PC depth they are entered at,
+    the cells from the head to register 0."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.nodes = {} # node -> (lo, left, head, final state) of its first segment
+        self.segments = {} # (node, depth) -> [count, steps in the operations]
+        self.registers = {} # register -> [incs, decnzs, failed, steps in the operations]
+        self.first = None # step count at the first operation
+        self.count = 0
+
+    def start(self, stepcount):
+        if self.first is None:
+            self.first = stepcount
+
+    def operation(self, rf, op, cost, final, after):
+        if self.count == self.limit:
+            return
+        kind, k, states, break_0, break_1 = op
+        node = (rf.state, final, after[3], after[5])
+        if node not in self.nodes:
+            self.nodes[node] = (rf.lo, rf.left, rf.head, final)
+        counts = self.segments.setdefault((node, rf.start - rf.head), [0, 0])
+        counts[0] += 1
+        counts[1] += cost
+        counts = self.registers.setdefault(k, [0, 0, 0, 0])
+        counts[0 if kind == "inc" else 1] += 1
+        counts[2] += final == break_1
+        counts[3] += cost
+        self.count += 1
+
+
+class StepCostModel:
+    """TM step costs of the segments of a machine built by TMBuilder.
+
+    A segment is a register operation and the run from its return to the
+    entry of the next one. The operation takes the closed form steps of
+    tmregmachine.operation_steps(), a function of the register index, the
+    register values and the PC depth (the cells from the head to register
+    0), shared with the registers engine. The rest of the segment
+    (dispatch, the decision DAG, marking the PC and the -1 register) only
+    reads the cells left of the register file; for a node, the path the
+    segment takes, it is taken as linear in the PC depth,
+
+        base + slope * (depth - base depth)
+
+    with base and base depth from the first segment of the node profiled
+    (found in the cycle cache of the registers engine) and slope from
+    running that segment twice more with the -1 register lengthened, the PC
+    unchanged."""
+
+    SHIFT = 16 # cells the -1 register is lengthened by to find a slope
+
+    def __init__(self, machine):
+        self.tm = machine
+        self.compiled = machine.compile()
+        machine.registers.prepare(machine, self.compiled)
+        self.entry = machine.regops.entry
+        self.names = machine.registers.names
+        self.lines = {} # node -> (base depth, base steps, slope)
+
+    def cycle(self, lo, left, head, final):
+        """Returns the cycle of tmregmachine.RegisterMachine.cycle() from
+        the return of the operation entered at head, through its cache"""
+        registers = self.tm.registers
+        key = (lo, left, head, final)
+        if key not in registers.cycles:
+            registers.cycles[key] = registers.cycle(self.tm, self.compiled, lo, left, head - 2, final)
+        return registers.cycles[key]
+
+    def line(self, node, first):
+        """Returns (base depth, base steps, slope) of node, whose first
+        segment was entered at head with the cells left of the register
+        file from lo, first being (lo, left, head, final state)"""
+        if node not in self.lines:
+            lo, left, head, final = first
+            one = bytes([self.tm.regops.one])
+            i = head - lo
+            steps = []
+            for shift in (0, self.SHIFT, 2 * self.SHIFT):
+                longer = self.tm.registers.intern(left[:i + 1] + one * shift + left[i + 1:])
+                after = self.cycle(lo - shift, longer, head - shift, final)
+                if after is None or (node[2], node[3]) != (after[3], after[5]):
+                    raise ValueError("the segment from {} takes another path with a longer -1 register".format(
+                        self.compiled.state_names[node[0]]))
+                steps.append(after[4])
+            if steps[2] - steps[1] != steps[1] - steps[0]:
+                raise ValueError("the segment from {} is not linear in the PC depth".format(
+                    self.compiled.state_names[node[0]]))
+            depth = lo + len(left) - head
+            self.lines[node] = (depth, steps[0], (steps[1] - steps[0]) // self.SHIFT)
+        return self.lines[node]
+
+    def profile(self, ops):
+        """Runs the machine from the start with the registers engine until
+        it has run ops register operations at the register level, and
+        returns the RegisterProfile of them"""
+        machine = self.tm
+        profile = RegisterProfile(ops)
+        engine = machine.engine
+        statetrace = machine.statetrace
+        machine.reset_tape()
+        machine.statename = machine.start
+        machine.stepcount = 0
+        machine.engine = "registers"
+        machine.registers.profile = profile
+        # without a trace to replay the runs are not split into slices
+        machine.statetrace = tm.StateTrace(0)
+        try:
+            while profile.count < ops:
+                count = profile.count
+                if not machine.run(1 << 28) or profile.count == count:
+                    break
+        finally:
+            machine.engine = engine
+            machine.registers.profile = None
+            machine.statetrace = statetrace
+        return profile
+
+    def estimate(self, profile):
+        """Returns (steps in register operations, steps between them) of
+        the segments of profile, so that profile.first plus both is the
+        estimated step count at the entry of the operation after them"""
+        registers = 0
+        between = 0
+        for (node, depth), (count, steps) in profile.segments.items():
+            base_depth, base, slope = self.line(node, profile.nodes[node])
+            registers += steps
+            between += count * (base + slope * (depth - base_depth))
+        return registers, between
+
+    def measure(self, profile):
+        """Runs the machine from the start with the table engine, observing
+        its steps, to the entry of the operation after those of profile.
+        Returns the step counts at the entries of the first operation and of
+        that one, or None for an entry not reached."""
+        tm = self.tm
+        c = self.compiled
+        inside = {state for op in self.entry if op is not None for state in op[2]}
+        # the transitions entering an operation from outside of any
+        starts = [t is not None and self.entry[t[2]] is not None and i // c.nsym not in inside
+                  for i, t in enumerate(c.table)]
+        entries = []
+
+        def observe(batch):
+            entries.extend(batch.first + n for n, i in enumerate(batch.ids, 1) if starts[i])
+
+        engine = tm.engine
+        events = tm.events
+        tm.reset_tape()
+        tm.statename = tm.start
+        tm.stepcount = 0
+        tm.engine = "table"
+        tm.events = tmevents.EventStream([observe])
+        try:
+            while len(entries) <= profile.count and tm.run(1 << 20):
+                pass
+        finally:
+            tm.engine = engine
+            tm.events = events
+        return entries[0] if entries else None, entries[profile.count] if len(entries) > profile.count else None
+
+    def report(self, profile):
+        registers, between = self.estimate(profile)
+        lines = ["{} register operations over {} nodes at {} PC depths".format(
+                     profile.count, len(profile.nodes), len({depth for node, depth in profile.segments})),
+                 "  {:>16} steps before the first".format(profile.first),
+                 "  {:>16} steps in register operations (2b, 2c)".format(registers),
+                 "  {:>16} steps between them (dispatch, decision DAG, 1b, 2e)".format(between),
+                 "  {:>16} steps estimated".format(profile.first + registers + between),
+                 "by register:          inc      decnz     failed           steps"]
+        for k, (incs, decs, failed, steps) in sorted(profile.registers.items(), key=lambda item: -item[1][3]):
+            lines.append("  {:<12} {:>10} {:>10} {:>10} {:>15}".format(
+                self.names.get(k, "#{}".format(k)), incs, decs, failed, steps))
+        return "\n".join(lines)
+
+
 class TMBuilder:
     """Subclass this class to build a particular turing machine"""
     def __init__(self):
@@ -596,13 +780,22 @@ class TMBuilder:
         self.name_sequences()
         self.generate()
         self.tm.gc()
+        self.tm.minimize()
         self.tm.statename = self.tm.start
 
+    def step_cost_model(self):
+        """Returns the StepCostModel of the built machine"""
+        return StepCostModel(self.tm)
 
     def process_cmdline(self):
         parser = argparse.ArgumentParser(description="Compiles to turing machines.")
         parser.add_argument('--debug', action='store_true',
                             help='Compile asserts')
+        parser.add_argument('--cost-model', type=int, metavar='OPS',
+                            help='Estimate the steps of the first OPS register operations of a run from '
+                            'its register level profile')
+        parser.add_argument('--check', action='store_true',
+                            help='With --cost-model, measure those steps with the table engine')
         args = parser.parse_args()
         self.debug = args.debug
 
@@ -611,6 +804,23 @@ class TMBuilder:
         print("framework:    {}".format(len(set(state[0] for state in self.tm.states if state[0][0] in "0123456789"))))
         print("decision DAG: {}".format(len(set(state[0] for state in self.tm.states if state[0][0] not in "0123456789"))))
         print("total:        {}".format(len(set(state[0] for state in self.tm.states))))
+        if args.cost_model:
+            model = self.step_cost_model()
+            profile = model.profile(args.cost_model)
+            if profile.first is None:
+                print("no register operations at the register level")
+            else:
+                print(model.report(profile))
+                if args.check:
+                    first, end = model.measure(profile)
+                    registers, between = model.estimate(profile)
+                    estimate = profile.first + registers + between
+                    print("table engine: first operation at {}, after the last at {}".format(first, end))
+                    if end is not None:
+                        print("error: {} steps ({:.4f}%)".format(estimate - end, 100 * (estimate - end) / end))
+            self.tm.reset_tape()
+            self.tm.statename = self.tm.start
+            self.tm.stepcount = 0
         debugger = tmdb.TMDB()
         debugger.tm = self.tm
         debugger.mainloop()
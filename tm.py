@@ -1,57 +1,1097 @@
 #!/usr/bin/python3
 
 # The tm file format is based on https://schaetzc.github.io/tursi/manual.html
-# limitations: #! fill must be a single symbol
+# limitations: #! fill must be a single symbol, at most 256 different symbols
 
-from collections import namedtuple
+import copy
+import gc
+import gzip
+import mmap
+import tempfile
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from itertools import groupby
+from tmmacro import MacroCache
+from tmrules import RuleEngine
+from tmcycle import CycleDetector
+from tmundo import UndoLog
+from tmbin import is_binary, read_binary, LazySource
+from tmprofile import Profiler
+from tmevents import EventStream
+from tmregops import RegisterOps
+from tmregmachine import RegisterMachine
 
 Transition = namedtuple("Transition", ["write", "direction", "nextstate"])
 
+# head movement for each direction symbol
+MOVES = {'l': -1, 'L': -1, '<': -1, 'n': 0, 'N': 0, 's': 0, 'S': 0, '=': 0, 'r': 1, 'R': 1, '>': 1}
+
+
+@contextmanager
+def collector_paused():
+    """Pauses the cycle collector, which building many small tuples at once
+    would otherwise start over and over"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class TransitionTable(dict):
+    """dict of (statename, symbol) -> Transition that counts modifications,
+    so compiled forms of the table know when they are stale"""
+
+    version = 0
+
+    def __setitem__(self, key, value):
+        self.version += 1
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.version += 1
+        super().__delitem__(key)
+
+    def pop(self, *args):
+        self.version += 1
+        return super().pop(*args)
+
+    def popitem(self):
+        self.version += 1
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.version += 1
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.version += 1
+        super().update(*args, **kwargs)
+
+    def clear(self):
+        self.version += 1
+        super().clear()
+
+
+class Tape:
+    """Two-sided tape of symbol codes stored in a bytearray that grows in both directions.
+
+    cells[pos] is the cell under the head and cells[origin] is cell 0, so
+    the absolute head position is pos - origin. Cells outside the buffer
+    hold fill. The engine loops work on cells and pos directly and call
+    extend() when pos runs off either end of the buffer."""
+
+    def __init__(self, fill=0):
+        self.fill = fill
+        self.reset()
+
+    def reset(self):
+        self.cells = bytearray([self.fill]) * 64
+        self.origin = 32
+        self.pos = 32
+        self.grown = False
+
+    @property
+    def head(self):
+        return self.pos - self.origin
+
+    def __getitem__(self, index):
+        index += self.origin
+        if 0 <= index < len(self.cells):
+            return self.cells[index]
+        return self.fill
+
+    def __setitem__(self, index, code):
+        self.ensure(index, index + 1)
+        self.cells[index + self.origin] = code
+
+    def read(self):
+        return self.cells[self.pos]
+
+    def write(self, code):
+        self.cells[self.pos] = code
+
+    def load(self, lo, codes, head):
+        """Replaces the contents with codes starting at absolute cell lo"""
+        self.reset()
+        self.set_range(lo, codes)
+        self.ensure(head, head + 1)
+        self.pos = head + self.origin
+
+    def get_range(self, lo, hi):
+        """Returns the codes of absolute cells lo to hi - 1 as bytes"""
+        if hi <= lo:
+            return b""
+        fill = bytes([self.fill])
+        first = max(lo + self.origin, 0)
+        last = min(hi + self.origin, len(self.cells))
+        if last <= first:
+            return fill * (hi - lo)
+        return fill * (first - lo - self.origin) + bytes(self.cells[first:last]) + \
+            fill * (hi + self.origin - last)
+
+    def set_range(self, lo, codes):
+        self.ensure(lo, lo + len(codes))
+        self.cells[lo + self.origin:lo + self.origin + len(codes)] = codes
+
+    def ensure(self, lo, hi):
+        """Grows the buffer to hold absolute cells lo to hi - 1"""
+        lo += self.origin
+        hi += self.origin
+        if lo < 0:
+            grow = max(-lo, len(self.cells) // 2)
+            self.cells[0:0] = bytes([self.fill]) * grow
+            self.origin += grow
+            self.pos += grow
+            hi += grow
+            self.grown = True
+        if hi > len(self.cells):
+            self.cells.extend(bytes([self.fill]) * max(hi - len(self.cells), len(self.cells) // 2))
+            self.grown = True
+
+    def extend(self, pos):
+        """Called by the engine loops when pos has run off cells. Grows the
+        buffer and returns the new pos, which may have been shifted."""
+        self.pos = pos
+        self.ensure(pos - self.origin, pos - self.origin + 1)
+        return self.pos
+
+    def move(self, move):
+        self.pos += move
+        if not 0 <= self.pos < len(self.cells):
+            self.extend(self.pos)
+
+    def copy(self):
+        tape = Tape(self.fill)
+        tape.cells = bytearray(self.cells)
+        tape.origin = self.origin
+        tape.pos = self.pos
+        return tape
+
+    def bounds(self):
+        """Returns the absolute (first, last) non-fill cells, or None if the tape is blank"""
+        fill = bytes([self.fill])
+        stripped = len(self.cells.lstrip(fill))
+        if stripped == 0:
+            return None
+        return (len(self.cells) - stripped - self.origin,
+                len(self.cells.rstrip(fill)) - 1 - self.origin)
+
+    def trim(self, margin=32):
+        """Drops fill cells beyond the non-blank extent and the head"""
+        bounds = self.bounds()
+        head = self.head
+        if bounds is None:
+            bounds = (head, head)
+        lo = max(min(bounds[0], head) - margin + self.origin, 0)
+        hi = min(max(bounds[1], head) + margin + 1 + self.origin, len(self.cells))
+        del self.cells[hi:]
+        del self.cells[:lo]
+        self.origin -= lo
+        self.pos -= lo
+        self.grown = False
+
+
+class RLETape:
+    """Run-length encoded tape.
+
+    left and right are stacks of [code, count] runs with the run nearest
+    the head last, cur is the code under the head and head is its absolute
+    position. Cells beyond the runs hold fill. run_rle() moves the head
+    across a whole run at once."""
+
+    grown = False
+
+    def __init__(self, fill=0):
+        self.fill = fill
+        self.reset()
+
+    def reset(self):
+        self.left = []
+        self.right = []
+        self.cur = self.fill
+        self.head = 0
+
+    def read(self):
+        return self.cur
+
+    def write(self, code):
+        self.cur = code
+
+    def move(self, move):
+        if move > 0:
+            behind, ahead = self.left, self.right
+        elif move < 0:
+            behind, ahead = self.right, self.left
+        else:
+            return
+        if behind and behind[-1][0] == self.cur:
+            behind[-1][1] += 1
+        else:
+            behind.append([self.cur, 1])
+        if ahead:
+            self.cur = ahead[-1][0]
+            if ahead[-1][1] == 1:
+                ahead.pop()
+            else:
+                ahead[-1][1] -= 1
+        else:
+            self.cur = self.fill
+        self.head += move
+
+    def runs(self):
+        """Yields (code, count) from left to right, starting at the first cell
+        held in the runs. The head cell is a run of its own."""
+        yield from ((code, count) for code, count in self.left)
+        yield (self.cur, 1)
+        yield from ((code, count) for code, count in reversed(self.right))
+
+    def first(self):
+        return self.head - sum(count for code, count in self.left)
+
+    def __getitem__(self, index):
+        offset = index - self.head
+        if offset == 0:
+            return self.cur
+        stack = self.right if offset > 0 else self.left
+        offset = abs(offset)
+        for code, count in reversed(stack):
+            if offset <= count:
+                return code
+            offset -= count
+        return self.fill
+
+    def __setitem__(self, index, code):
+        if index == self.head:
+            self.cur = code
+            return
+        stack = self.right if index > self.head else self.left
+        offset = abs(index - self.head)
+        i = len(stack) - 1
+        while i >= 0 and offset > stack[i][1]:
+            offset -= stack[i][1]
+            i -= 1
+        if i < 0:
+            # beyond the runs, pad with fill
+            if offset > 1:
+                stack.insert(0, [self.fill, offset - 1])
+            stack.insert(0, [code, 1])
+            return
+        run = stack[i]
+        if run[0] == code:
+            return
+        # split the run around the cell, the stack is ordered outwards-first
+        stack[i:i + 1] = [r for r in ([run[0], run[1] - offset], [code, 1], [run[0], offset - 1]) if r[1]]
+
+    def get_range(self, lo, hi):
+        """Returns the codes of absolute cells lo to hi - 1 as bytes, in one
+        pass over the runs"""
+        if hi <= lo:
+            return b""
+        out = bytearray()
+        position = self.first()
+        if lo < position:
+            out += bytes([self.fill]) * (min(position, hi) - lo)
+        for code, count in self.runs():
+            if position >= hi:
+                break
+            first = max(position, lo)
+            last = min(position + count, hi)
+            if first < last:
+                out += bytes([code]) * (last - first)
+            position += count
+        out += bytes([self.fill]) * (hi - lo - len(out))
+        return bytes(out)
+
+    def set_range(self, lo, codes):
+        """Writes codes from absolute cell lo, rebuilding the runs"""
+        if not codes:
+            return
+        first = min(self.first(), lo, self.head)
+        last = max(self.first() + sum(count for code, count in self.runs()), lo + len(codes), self.head + 1)
+        cells = bytearray(self.get_range(first, last))
+        cells[lo - first:lo - first + len(codes)] = codes
+        self.load(first, cells, self.head)
+
+    def load(self, lo, codes, head):
+        self.reset()
+        self.head = head
+        self.cur = codes[head - lo] if lo <= head < lo + len(codes) else self.fill
+        self.left = [[code, len(list(group))] for code, group in groupby(codes[:max(head - lo, 0)])]
+        if head > lo + len(codes):
+            self.left.append([self.fill, head - lo - len(codes)])
+        self.right = [[code, len(list(group))] for code, group in groupby(reversed(codes[max(head - lo + 1, 0):]))]
+        if lo > head + 1:
+            self.right.append([self.fill, lo - head - 1])
+        self.trim()
+
+    def bounds(self):
+        first = None
+        last = None
+        position = self.first()
+        for code, count in self.runs():
+            if code != self.fill:
+                if first is None:
+                    first = position
+                last = position + count - 1
+            position += count
+        if first is None:
+            return None
+        return (first, last)
+
+    def trim(self):
+        """Drops fill runs at the far ends"""
+        for stack in (self.left, self.right):
+            while stack and stack[0][0] == self.fill:
+                del stack[0]
+
+
+class ChunkTape:
+    """Tape stored as fixed-size chunks that forks share copy-on-write.
+
+    chunks maps chunk index to a bytearray of size cells, chunk i holding
+    absolute cells i*size - size/2 to i*size + size/2 - 1 (cell 0 is in the
+    middle of a chunk, where machines usually start); missing chunks hold
+    fill.
+    cells is the chunk under the head, with origin and pos as for Tape, so
+    the engine loops run on it unchanged: extend() is called when the head
+    leaves the chunk and moves to the next one. A chunk is copied when this
+    tape first touches it after a fork, so the chunk the engines write to is
+    always owned."""
+
+    def __init__(self, fill=0, size=4096):
+        self.fill = fill
+        self.size = size
+        self.half = size // 2
+        self.reset()
+
+    def reset(self):
+        self.chunks = {}
+        self.owned = set() # chunks not shared with a fork
+        self.index = 0
+        self.cells = self.writable(0)
+        self.grown = False
+        self.origin = self.half
+        self.pos = self.half
+
+    def writable(self, index):
+        """Returns chunk index, copying it first if it is shared"""
+        if index not in self.owned:
+            chunk = self.chunks.get(index)
+            if chunk is None:
+                self.chunks[index] = bytearray([self.fill]) * self.size
+                self.grown = True
+            else:
+                self.chunks[index] = bytearray(chunk)
+            self.owned.add(index)
+        return self.chunks[index]
+
+    @property
+    def head(self):
+        return self.pos - self.origin
+
+    def __getitem__(self, index):
+        index, offset = divmod(index + self.half, self.size)
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            return self.fill
+        return chunk[offset]
+
+    def __setitem__(self, index, code):
+        index, offset = divmod(index + self.half, self.size)
+        self.writable(index)[offset] = code
+
+    def read(self):
+        return self.cells[self.pos]
+
+    def write(self, code):
+        self.cells[self.pos] = code
+
+    def load(self, lo, codes, head):
+        self.reset()
+        self.set_range(lo, codes)
+        self.extend(head + self.origin)
+
+    def get_range(self, lo, hi):
+        size = self.size
+        parts = []
+        while lo < hi:
+            index, offset = divmod(lo + self.half, size)
+            count = min(size - offset, hi - lo)
+            chunk = self.chunks.get(index)
+            parts.append(bytes([self.fill]) * count if chunk is None else bytes(chunk[offset:offset + count]))
+            lo += count
+        return b"".join(parts)
+
+    def set_range(self, lo, codes):
+        size = self.size
+        i = 0
+        while i < len(codes):
+            index, offset = divmod(lo + i + self.half, size)
+            count = min(size - offset, len(codes) - i)
+            self.writable(index)[offset:offset + count] = codes[i:i + count]
+            i += count
+
+    def ensure(self, lo, hi):
+        """Chunks are created as the head reaches them"""
+        pass
+
+    def extend(self, pos):
+        """Called by the engine loops when pos has run off cells. Moves to
+        the chunk holding the head and returns the new pos."""
+        head = pos - self.origin
+        self.index = (head + self.half) // self.size
+        self.cells = self.writable(self.index)
+        self.origin = self.half - self.index * self.size
+        self.pos = head + self.origin
+        return self.pos
+
+    def move(self, move):
+        self.pos += move
+        if not 0 <= self.pos < len(self.cells):
+            self.extend(self.pos)
+
+    def fork(self):
+        """Returns a tape with the same contents sharing all chunks but the
+        one under the head. Both tapes copy the other chunks as they reach
+        them."""
+        tape = ChunkTape(self.fill, self.size)
+        tape.chunks = dict(self.chunks)
+        tape.grown = self.grown
+        # the engines may still hold this tape's cells, so the fork gets the copy
+        self.owned = {self.index}
+        tape.owned = set()
+        tape.index = self.index
+        tape.cells = tape.writable(self.index)
+        tape.origin = self.origin
+        tape.pos = self.pos
+        return tape
+
+    copy = fork
+
+    def bounds(self):
+        fill = bytes([self.fill])
+        first = last = None
+        for index in sorted(self.chunks):
+            chunk = bytes(self.chunks[index])
+            stripped = len(chunk.lstrip(fill))
+            if stripped:
+                base = index * self.size - self.half
+                if first is None:
+                    first = base + len(chunk) - stripped
+                last = base + len(chunk.rstrip(fill)) - 1
+        if first is None:
+            return None
+        return (first, last)
+
+    def trim(self):
+        """Drops chunks of fill other than the one under the head"""
+        fill = bytes([self.fill])
+        for index in [i for i, chunk in self.chunks.items() if i != self.index and not chunk.strip(fill)]:
+            del self.chunks[index]
+            self.owned.discard(index)
+        self.grown = False
+
+
+class MmapTape(ChunkTape):
+    """ChunkTape whose chunks live in a memory-mapped file, one byte per cell.
+
+    Chunks are allocated at the end of the file in the order the head
+    reaches them, whichever direction it goes, and mapped segment chunks at
+    a time. The chunks dict holds memoryviews into the mappings, which the
+    engine loops index like a bytearray; the operating system keeps the
+    pages in use in memory. The file is a temporary file unless filename is
+    given. Chunks are never freed and the tape cannot be forked."""
+
+    def __init__(self, fill=0, filename=None, size=1 << 20, segment=64):
+        self.filename = filename
+        # mappings start at a multiple of the allocation granularity
+        granularity = mmap.ALLOCATIONGRANULARITY
+        self.length = -(-segment * size // granularity) * granularity
+        self.segment = self.length // size
+        self.file = None
+        self.maps = []
+        self.chunks = {}
+        super().__init__(fill, size)
+
+    def reset(self):
+        self.close()
+        self.file = open(self.filename, "w+b") if self.filename else tempfile.TemporaryFile()
+        self.allocated = 0
+        super().reset()
+
+    def close(self):
+        """Releases the chunks, then closes the mappings and the file"""
+        for chunk in self.chunks.values():
+            chunk.release()
+        self.chunks = {}
+        self.cells = None
+        for mapping in self.maps:
+            try:
+                mapping.close()
+            except BufferError:
+                # a view of it is still held elsewhere, it closes when freed
+                pass
+        self.maps = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def writable(self, index):
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            segment, slot = divmod(self.allocated, self.segment)
+            if segment == len(self.maps):
+                self.file.truncate((segment + 1) * self.length)
+                self.maps.append(mmap.mmap(self.file.fileno(), self.length, offset=segment * self.length))
+            self.allocated += 1
+            chunk = memoryview(self.maps[segment])[slot * self.size:(slot + 1) * self.size]
+            if self.fill:
+                chunk[:] = bytes([self.fill]) * self.size
+            self.chunks[index] = chunk
+        return chunk
+
+    def fork(self):
+        raise ValueError("an mmap tape cannot be forked")
+
+    copy = fork
+
+    def trim(self):
+        self.grown = False
+
+
+TAPES = {"bytes": Tape, "rle": RLETape, "chunks": ChunkTape, "mmap": MmapTape}
+
+ENGINES = ("table", "codegen", "macro", "rules", "regops", "registers")
+
+
+class CompiledMachine:
+    """The transition table with states and symbols interned to small ints.
+
+    table[state * nsym + symbol] is (write, move, nextstate) with move -1, 0
+    or 1, or None if the transition is undefined."""
+
+    def __init__(self, tm):
+        self.state_names = []
+        self.state_ids = {}
+        self.generated_run = None
+
+        for (statename, symbol), transition in tm.states.items():
+            self.state_id(statename)
+            self.state_id(transition.nextstate)
+            tm.symbol_code(symbol)
+            tm.symbol_code(transition.write)
+
+        # symbol codes are the ones used on the tape
+        self.symbol_names = list(tm.symbol_names)
+        self.symbol_ids = dict(tm.symbol_ids)
+        self.nsym = len(self.symbol_names)
+        self.table = [None] * (len(self.state_names) * self.nsym)
+        for (statename, symbol), transition in tm.states.items():
+            self.table[self.state_ids[statename] * self.nsym + self.symbol_ids[symbol]] = \
+                (self.symbol_ids[transition.write], MOVES[transition.direction],
+                 self.state_ids[transition.nextstate])
+
+    def state_id(self, name):
+        if name not in self.state_ids:
+            self.state_ids[name] = len(self.state_names)
+            self.state_names.append(name)
+        return self.state_ids[name]
+
+    def generated(self):
+        """Returns a run function specialized to this table, generating it on first use.
+
+        The function is run(left, right, symbol, state, limit, stop, loopstop)
+        -> (symbol, state, steps, halted). States are dispatched by a binary
+        search on the state id held in a local variable, the writes, moves and
+        next states are constants in the code, and transitions that stay in
+        the same state loop without going back through the dispatch."""
+
+        if self.generated_run is None:
+            lines = ["def run(tape, state, limit, stop, loopstop):",
+                     "    cells = tape.cells",
+                     "    pos = tape.pos",
+                     "    end = len(cells)",
+                     "    steps = 0",
+                     "    halted = False",
+                     "    while steps != limit:"]
+            self.generate_dispatch(lines, 0, len(self.state_names), 2)
+            lines.append("    tape.pos = pos")
+            lines.append("    return state, steps, halted")
+            namespace = {}
+            exec(compile("\n".join(lines) + "\n", "<generated {}>".format(id(self)), "exec"), namespace)
+            self.generated_run = namespace["run"]
+        return self.generated_run
+
+    def generate_dispatch(self, lines, lo, hi, depth):
+        indent = "    " * depth
+        if hi - lo == 1:
+            self.generate_state(lines, lo, depth)
+        else:
+            mid = (lo + hi) // 2
+            lines.append("{}if state < {}:".format(indent, mid))
+            self.generate_dispatch(lines, lo, mid, depth + 1)
+            lines.append("{}else:".format(indent))
+            self.generate_dispatch(lines, mid, hi, depth + 1)
+
+    def generate_state(self, lines, state, depth):
+        indent = "    " * depth
+        lines.append("{}# {}".format(indent, self.state_names[state]))
+        keyword = "if"
+        for symbol in range(self.nsym):
+            transition = self.table[state * self.nsym + symbol]
+            if transition is None:
+                continue
+            write, move, nextstate = transition
+            code = []
+            if write != symbol:
+                code.append("cells[pos] = {}".format(write))
+            if move < 0:
+                code += ["pos -= 1",
+                         "if pos < 0:",
+                         "    pos = tape.extend(pos)",
+                         "    cells = tape.cells",
+                         "    end = len(cells)"]
+            elif move > 0:
+                code += ["pos += 1",
+                         "if pos == end:",
+                         "    pos = tape.extend(pos)",
+                         "    cells = tape.cells",
+                         "    end = len(cells)"]
+            code.append("steps += 1")
+
+            if keyword == "if":
+                lines.append("{}symbol = cells[pos]".format(indent))
+            lines.append("{}{} symbol == {}:".format(indent, keyword, symbol))
+            keyword = "elif"
+            if nextstate == state:
+                lines.append("{}    while True:".format(indent))
+                lines.extend("{}        {}".format(indent, l) for l in code)
+                lines.append("{}        if cells[pos] != {} or steps == limit or loopstop[{}]:"
+                             .format(indent, symbol, state))
+                lines.append("{}            break".format(indent))
+                lines.append("{}    if loopstop[{}]:".format(indent, state))
+                lines.append("{}        break".format(indent))
+            else:
+                lines.extend("{}    {}".format(indent, l) for l in code)
+                lines.append("{}    state = {}".format(indent, nextstate))
+                lines.append("{}    if stop[{}]:".format(indent, nextstate))
+                lines.append("{}        break".format(indent))
+
+        if keyword == "if":
+            lines.append("{}halted = True".format(indent))
+            lines.append("{}break".format(indent))
+        else:
+            lines.append("{}else:".format(indent))
+            lines.append("{}    halted = True".format(indent))
+            lines.append("{}    break".format(indent))
+
+
+class StateTrace:
+    """The last depth (state, symbol, count) entries of a run, newest first.
+
+    A ring buffer over preallocated lists: recording an entry overwrites the
+    oldest one instead of building a new list. With depth 0 nothing is kept."""
+
+    def __init__(self, depth=11):
+        self.depth = depth
+        self.clear()
+
+    def clear(self):
+        self.states = [None] * self.depth
+        self.symbols = [None] * self.depth
+        self.counts = [0] * self.depth
+        self.newest = 0
+        self.size = 0
+
+    def add(self, statename, symbol, count):
+        """Records count steps in (statename, symbol), merged with the newest
+        entry if it is the same pair"""
+        if not self.depth:
+            return
+        i = self.newest
+        if self.size and self.states[i] == statename and self.symbols[i] == symbol:
+            self.counts[i] += count
+            return
+        i = (i + 1) % self.depth
+        self.states[i] = statename
+        self.symbols[i] = symbol
+        self.counts[i] = count
+        self.newest = i
+        if self.size < self.depth:
+            self.size += 1
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not -self.size <= index < self.size:
+            raise IndexError("statetrace index out of range")
+        i = (self.newest - index % self.size) % self.depth
+        return (self.states[i], self.symbols[i], self.counts[i])
+
+    def __iter__(self):
+        return (self[index] for index in range(self.size))
+
+    def __reversed__(self):
+        return (self[index] for index in range(self.size - 1, -1, -1))
+
+    def copy(self):
+        trace = StateTrace(self.depth)
+        trace.states = list(self.states)
+        trace.symbols = list(self.symbols)
+        trace.counts = list(self.counts)
+        trace.newest = self.newest
+        trace.size = self.size
+        return trace
+
+
+class TraceReplay:
+    """Fills tm.statetrace for run(), whose loops do not trace, as one of
+    its watchers. The configuration is kept at the start of the run and at
+    steps further apart the longer it runs, only the last two of those
+    beside the start. When the run ends, the engine runs again on a copy
+    from the last one kept to `tail` steps before the end and the table
+    replays the rest on a Tape, tracing it; the tail grows until it holds
+    the whole trace or reaches the start of the run, whose trace it then
+    continues.
+
+    Once the tape spans more than `cells` cells the replay gives up and
+    the trace only gets the configuration the run ends in, as it does for
+    an MmapTape, which run() does not replay."""
+
+    def __init__(self, tm, c, tail=1 << 16, cells=1 << 24):
+        self.tail = tail
+        self.cells = cells
+        self.compiled = c
+        self.prior = tm.statetrace
+        self.start = tm.stepcount
+        self.snapshots = []
+        self.next = tm.stepcount + tail
+        self.keep(tm)
+
+    def span(self, tm):
+        """The (first, last) cells of tm's tape holding the head and all its
+        non-fill cells, or None, giving up, if they are over self.cells"""
+        bounds = tm.tape.bounds()
+        head = tm.tape.head
+        lo, hi = (head, head) if bounds is None else (min(bounds[0], head), max(bounds[1], head))
+        if hi - lo >= self.cells:
+            self.snapshots = None
+            return None
+        return lo, hi
+
+    def keep(self, tm):
+        """Keeps the configuration of tm, unless its tape is too long"""
+        span = self.span(tm)
+        if span is None:
+            return
+        lo, hi = span
+        head = tm.tape.head
+        self.snapshots.append((tm.stepcount, self.compiled.state_ids[tm.statename], lo,
+                               tm.tape.get_range(lo, hi + 1), head))
+        if len(self.snapshots) > 3:
+            del self.snapshots[1]
+
+    def slice(self, stepcount):
+        if self.snapshots is None:
+            return 1 << 62
+        return self.next - stepcount
+
+    def poll(self, tm):
+        if self.snapshots is not None and tm.stepcount >= self.next:
+            self.keep(tm)
+            self.next = tm.stepcount + max(self.tail, (tm.stepcount - self.start) // 4)
+
+    def rerun(self, tm, step):
+        """Returns the configuration at step of the run, as (state, Tape)"""
+        first, state, lo, codes, head = max(s for s in self.snapshots if s[0] <= step)
+        other = TuringMachine(trace_depth=0)
+        other.states = tm.states
+        other.symbol_names = tm.symbol_names
+        other.symbol_ids = tm.symbol_ids
+        other.compiled = tm.compiled
+        other.compiled_key = tm.compiled_key
+        other.macro = tm.macro
+        other.engine = tm.engine
+        other.tape = (RLETape if isinstance(tm.tape, RLETape) else Tape)(tm.tape.fill)
+        other.tape.load(lo, codes, head)
+        other.statename = self.compiled.state_names[state]
+        other.stepcount = first
+        other.run(step - first)
+        if type(other.tape) is not Tape:
+            # the rules engine and run_rle() leave an RLETape
+            other.use_tape("bytes")
+        return self.compiled.state_ids[other.statename], other.tape
+
+    def replay(self, state, tape, steps, keep):
+        """Runs the table steps steps from state on tape, returning the
+        last keep [state, symbol, count] entries of their trace"""
+        c = self.compiled
+        table = c.table
+        nsym = c.nsym
+        cells = tape.cells
+        pos = tape.pos
+        end = len(cells)
+        entries = deque(maxlen=keep)
+        entry = None
+        for _ in range(steps):
+            write, move, state = table[state * nsym + cells[pos]]
+            cells[pos] = write
+            pos += move
+            if pos == end or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+                end = len(cells)
+            if entry is not None and entry[0] == state and entry[1] == cells[pos]:
+                entry[2] += 1
+            else:
+                entry = [state, cells[pos], 1]
+                entries.append(entry)
+        return entries
+
+    def finish(self, tm):
+        """Replaces tm.statetrace with the trace of the run"""
+        if self.snapshots is not None:
+            # the tape may have grown since the last snapshot
+            self.span(tm)
+        if self.snapshots is None:
+            if tm.stepcount != self.start:
+                tm.trace(tm.statename, tm.symbol, 1)
+            return
+        depth = self.prior.depth
+        start = self.start
+        tail = self.tail
+        while True:
+            base = max(tm.stepcount - tail, start)
+            state, tape = self.rerun(tm, base)
+            entries = self.replay(state, tape, tm.stepcount - base, depth + 1)
+            if base == start or len(entries) > depth:
+                break
+            tail *= 4
+        if base == start:
+            trace = self.prior.copy()
+        else:
+            trace = StateTrace(depth)
+            # the oldest may have begun before the base
+            entries.popleft()
+        c = self.compiled
+        for state, symbol, count in entries:
+            trace.add(c.state_names[state], c.symbol_names[symbol], count)
+        tm.statetrace = trace
+
+
 class TuringMachine:
-    def __init__(self):
+    def __init__(self, trace_depth=11):
         self.start = "0"
-        self.states = {}
+        self.states = TransitionTable()
         self.statename = "0"
         self.source = {}
         self.sourcemap = {}
-        self.left = []
-        self.right = []
-        self.symbol = "0"
-        self.fill = "0"
+        self.symbol_names = [] # symbol codes used on the tape
+        self.symbol_ids = {}
+        self.tape = Tape(self.symbol_code("0"))
         self.symbols = set() # symbols seen so far
         self.stepcount = 0
-        self.statetrace = [("0", '0', 0)]
+        self.statetrace = StateTrace(trace_depth)
+        self.statetrace.add("0", '0', 0)
         self.looping = False
+        self.compiled = None
+        self.compiled_key = None
+        self.engine = "table" # or "codegen", "macro", "rules", "regops" or "registers", see run()
+        self.macro = MacroCache()
+        self.regops = RegisterOps()
+        self.registers = RegisterMachine()
+        self.rules = RuleEngine()
+        self.detect_loops = False
+        self.cycles = CycleDetector()
+        self.undo = UndoLog()
+        self.checkpoints = None
+        self.milestones = None
+        self.watchers = []
+        self.profile = None # a tmprofile.Profiler while profiling
+        self.recorder = None # a tmtrace.TraceRecorder while recording
+        self.events = None # a tmevents.EventStream while observed
+        self.observed = EventStream() # serves profile and recorder without events
+
+    def symbol_code(self, symbol):
+        """Returns the tape code for symbol, assigning a new one if needed"""
+        if symbol not in self.symbol_ids:
+            if len(self.symbol_names) == 256:
+                raise ValueError("too many symbols")
+            self.symbol_ids[symbol] = len(self.symbol_names)
+            self.symbol_names.append(symbol)
+        return self.symbol_ids[symbol]
+
+    @property
+    def fill(self):
+        return self.symbol_names[self.tape.fill]
+
+    @fill.setter
+    def fill(self, symbol):
+        self.tape.fill = self.symbol_code(symbol)
+
+    @property
+    def symbol(self):
+        return self.symbol_names[self.tape.read()]
+
+    @symbol.setter
+    def symbol(self, symbol):
+        self.tape.write(self.symbol_code(symbol))
+
+    @property
+    def left(self):
+        """The cells left of the head, nearest last, as a list of symbols"""
+        bounds = self.tape.bounds()
+        head = self.tape.head
+        first = head if bounds is None else min(bounds[0], head)
+        return [self.symbol_names[c] for c in self.tape.get_range(first, head)]
+
+    @property
+    def right(self):
+        """The cells right of the head, nearest last, as a list of symbols"""
+        bounds = self.tape.bounds()
+        head = self.tape.head
+        last = head if bounds is None else max(bounds[1], head)
+        return [self.symbol_names[c] for c in reversed(self.tape.get_range(head + 1, last + 1))]
+
+    def tape_bounds(self):
+        """Returns the (first, last) cells relative to the head spanning the
+        head and all non-fill cells"""
+        bounds = self.tape.bounds()
+        head = self.tape.head
+        if bounds is None:
+            return (0, 0)
+        return (min(bounds[0], head) - head, max(bounds[1], head) - head)
+
+    def reset_tape(self):
+        self.tape.reset()
+        self.undo.clear()
+
+    def use_tape(self, kind):
+        """Moves the tape contents into a tape of the given kind, one of TAPES"""
+        tape = TAPES[kind](self.tape.fill)
+        bounds = self.tape.bounds()
+        head = self.tape.head
+        lo, hi = (head, head) if bounds is None else (min(bounds[0], head), max(bounds[1], head))
+        tape.load(lo, self.tape.get_range(lo, hi + 1), head)
+        if isinstance(self.tape, MmapTape):
+            self.tape.close()
+        self.tape = tape
+        if isinstance(tape, RLETape):
+            # run_rle() does not log steps
+            self.undo.clear()
+
+    def fork(self):
+        """Returns a TuringMachine in the same configuration that runs
+        independently of this one.
+
+        The tape is switched to a ChunkTape if needed and shared chunk by
+        chunk copy-on-write. The transition table, symbols, compiled machine
+        and macro cache are shared, so a change to the table made through
+        either machine applies to both; the state, step count, trace, tape,
+        undo log, cycle detector and rule engine are per machine. The fork
+        has no recorder, event stream or watchers."""
+
+        if not isinstance(self.tape, ChunkTape):
+            self.use_tape("chunks")
+        other = copy.copy(self)
+        other.tape = self.tape.fork()
+        other.statetrace = self.statetrace.copy()
+        other.cycles = CycleDetector()
+        other.regops = RegisterOps()
+        other.registers = RegisterMachine()
+        other.rules = RuleEngine(self.rules.window, self.rules.threshold, self.rules.proof_steps,
+                                 self.rules.max_backoff, self.rules.history_size, self.rules.verbose)
+        other.undo = UndoLog(self.undo.budget)
+        if self.profile is not None:
+            other.profile = Profiler()
+        other.recorder = None
+        other.events = None
+        other.observed = EventStream()
+        other.watchers = []
+        return other
 
     def tape_at(self, index):
-        if index == 0:
-            return self.symbol
-        elif index < 0 and len(self.left) >= -index:
-            return self.left[len(self.left) + index]
-        elif index > 0 and len(self.right) >= index:
-            return self.right[len(self.right) - index]
-        else:
-            return self.fill
+        return self.symbol_names[self.tape[self.tape.head + index]]
+
+    def tape_range(self, lo, hi):
+        """The symbols of cells lo to hi - 1 relative to the head, read at once"""
+        head = self.tape.head
+        return [self.symbol_names[code] for code in self.tape.get_range(head + lo, head + hi)]
 
     def write_tape_at(self, index, symbol):
-        if index == 0:
-            self.symbol = symbol
-        elif index < 0:
-            while len(self.left) <= -index:
-                self.left.insert(0, self.fill)
-            self.left[len(self.left) + index] = symbol
-        else:
-            while len(self.right) <= index:
-                self.right.insert(0, self.fill)
-            self.right[len(self.right) - index] = symbol
+        self.tape[self.tape.head + index] = self.symbol_code(symbol)
+
+    def write_tape_range(self, index, symbols):
+        self.tape.set_range(self.tape.head + index, bytes(self.symbol_code(s) for s in symbols))
+
+    def write_tape_spec(self, args):
+        """Writes the tape like "#! write": args is [symbols] or [index, symbols]"""
+        if len(args) == 1:
+            self.write_tape_range(0, args[0])
+        if len(args) == 2:
+            if args[1].endswith("<"):
+                self.write_tape_range(int(args[0][:-1]) - len(args[1]) + 1, args[1])
+            else:
+                self.write_tape_range(int(args[0]), args[1])
 
 
-    def load(self, filename):
-        linenumber = 1
-        with open(filename,"r") as f:
-            for l in f:
-                self.loadline(l, filename, linenumber)
-                linenumber = linenumber + 1
+    def load(self, filename, keep_source=True):
+        """Loads a .tm file, gzip compressed if its name ends in .gz, or a
+        .tmb file (see tmbin). Without keep_source the lines are not kept
+        in self.source and self.sourcemap, so they cannot be listed and
+        save() writes no comments."""
+        if is_binary(filename):
+            self.load_binary(filename, keep_source)
+            return
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rt") as f, collector_paused():
+            self.load_lines(f, filename, keep_source)
+
+    def load_lines(self, lines, filename, keep_source=True):
+        """Loads the lines of a file like loadline(), adding the transitions
+        to the table in bulk"""
+        source = self.source
+        sourcemap = self.sourcemap
+        table = {}
+        lineno = 0
+        for lineno, line in enumerate(lines, 1):
+            if keep_source:
+                source[(filename, lineno)] = line.rstrip()
+            if line.startswith("#"):
+                if line.startswith("#!"):
+                    # directives see the transitions loaded so far
+                    self.add_transitions(table)
+                    table = {}
+                    self.directive(line[2:].split())
+                continue
+            fields = line.split()
+            if len(fields) == 5 and len(fields[1]) == 1 and len(fields[2]) == 1 and len(fields[3]) == 1 \
+                    and fields[3] in "lL<nNsS=rR>":
+                key = (fields[0], fields[1])
+                table[key] = Transition(fields[2], fields[3], fields[4])
+                if keep_source:
+                    sourcemap[key] = (filename, lineno)
+        self.add_transitions(table)
+
+    def add_transitions(self, table):
+        self.states.update(table)
+        self.symbols.update(key[1] for key in table)
+        self.symbols.update(transition.write for transition in table.values())
+
+    def load_binary(self, filename, keep_source=True):
+        """Loads a machine converted by tmbin, reading its source lines only when first needed"""
+        machine = read_binary(filename)
+        with collector_paused():
+            self.add_transitions({key: Transition(*transition) for key, transition in machine.table()})
+        self.start = machine.start
+        self.fill = machine.fill
+        self.write_tape_range(machine.tape_lo, machine.tape_symbols())
+        if keep_source:
+            self.source, self.sourcemap = LazySource.pair(self.source, self.sourcemap, machine)
 
     def loadline(self, line, filename, lineno):
 
@@ -59,26 +1099,7 @@ class TuringMachine:
 
         if line.startswith("#"):
             if line.startswith("#!"):
-                line = line[2:].strip().split()
-                if line[0] == "start" and len(line) > 1:
-                    self.start = line[1]
-                if line[0] == "fill" and len(line) > 1 and len(line[1]) == 1:
-                    self.fill = line[1]
-                if line[0] == "write" and len(line) == 2:
-                    for (i, s) in enumerate(line[1]):
-                        self.write_tape_at(i, s)
-                if line[0] == "write" and len(line) == 3:
-                    if line[2].endswith("<"):
-                        for (i, s) in enumerate(line[2]):
-                            self.write_tape_at(int(line[1][:-1]) - len(line[2]) + 1 + i, s)
-                    else:
-                        for (i, s) in enumerate(line[2]):
-                            self.write_tape_at(int(line[1]) + i, s)
-                if line[0] == "delete" and len(line) == 3:
-                    if (line[1], line[2]) in self.states:
-                        del self.states[(line[1], line[2])]
-                    else:
-                        print("state not found")
+                self.directive(line[2:].strip().split())
         elif line.strip() != "":
             #attempt to load as a state transition
             line = line.strip().split()
@@ -92,59 +1113,388 @@ class TuringMachine:
 
         return True
 
+    def directive(self, line):
+        """Applies the words of a "#!" line"""
+        if not line:
+            return
+        if line[0] == "start" and len(line) > 1:
+            self.start = line[1]
+        if line[0] == "fill" and len(line) > 1 and len(line[1]) == 1:
+            self.fill = line[1]
+        if line[0] == "write":
+            self.write_tape_spec(line[1:])
+        if line[0] == "delete" and len(line) == 3:
+            if (line[1], line[2]) in self.states:
+                del self.states[(line[1], line[2])]
+            else:
+                print("state not found")
+
+    def comment_blocks(self):
+        """Maps the (filename, lineno) of each source line that follows a
+        block of comment lines to the line number the block starts at"""
+        blocks = {}
+        first = None
+        previous = None
+        for key, line in self.source.items():
+            filename, lineno = key
+            if previous != (filename, lineno - 1):
+                first = None
+            if line.startswith("#"):
+                if first is None:
+                    first = lineno
+            elif first is not None:
+                blocks[key] = first
+                first = None
+            previous = key
+        return blocks
 
     def save(self, filename):
-        with open(filename, "w") as f:
-            f.write("#! start {}\n".format(self.start))
+        """Writes the start state and transition table, each transition after
+        the comments above it in its source, gzip compressed if filename
+        ends in .gz"""
+        blocks = self.comment_blocks()
+        source = self.source
+        sourcemap = self.sourcemap
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "wt") as f, collector_paused():
+            write = f.write
+            write("#! start {}\n".format(self.start))
 
-            for statetuple in sorted(self.states):
+            for (state, symbol), transition in sorted(self.states.items()):
                 # print associated comments with the state first
-                if statetuple in self.sourcemap:
-                    (filename, lineno) = self.sourcemap[statetuple]
-                    while (filename, lineno - 1) in self.source and self.source[(filename, lineno - 1)].startswith("#"):
-                        lineno = lineno - 1
-                    while self.source[(filename, lineno)].startswith("#"):
-                        if not self.source[(filename, lineno)].startswith("#!"):
-                            f.write("{}\n".format(self.source[(filename, lineno)]))
-                        lineno = lineno + 1
-                f.write("{} {} {} {} {}\n".format(*statetuple, *self.states[statetuple][:3]))
+                location = sourcemap.get((state, symbol))
+                if location in blocks:
+                    filename, lineno = location
+                    for i in range(blocks[location], lineno):
+                        line = source[(filename, i)]
+                        if not line.startswith("#!"):
+                            write(line + "\n")
+                write(" ".join((state, symbol, *transition[:3])) + "\n")
 
 
     def step(self):
         self.looping = False
+        if self.undo.size:
+            self.undo.clear()
         try:
             transition = self.states[(self.statename, self.symbol)]
         except KeyError:
             return False
-        symbol = transition.write
-        if transition.direction in ('l', 'L', '<'):
-            self.right.append(symbol)
-            if self.left:
-                self.symbol = self.left.pop()
-            else:
-                self.symbol = self.fill
-                looping = (self.statename, self.fill) in self.states \
-                    and self.states[(self.statename, self.fill)].nextstate == self.statename \
-                    and self.states[(self.statename, self.fill)].direction in ('l', 'L', '<')
-        elif transition.direction in ('r', 'R', '>'):
-            self.left.append(symbol)
-            if self.right:
-                self.symbol = self.right.pop()
-            else:
-                self.symbol = self.fill
-                looping = (self.statename, self.fill) in self.states \
-                    and self.states[(self.statename, self.fill)].nextstate == self.statename \
-                    and self.states[(self.statename, self.fill)].direction in ('r', 'R', '>')
+        events = self.event_stream()
+        if events is not None:
+            c = self.compile()
+            events.step(self, c, c.state_ids[self.statename] * c.nsym + self.symbol_code(self.symbol))
+        self.symbol = transition.write
+        self.tape.move(MOVES[transition.direction])
 
         self.statename = transition.nextstate
-        if (self.statename, self.symbol) == self.statetrace[0][:2]:
-            self.statetrace[0] = (self.statename, self.symbol, self.statetrace[0][2] + 1)
-        else:
-            self.statetrace = [(self.statename, self.symbol, 1)] + self.statetrace[:10]
+        if self.statetrace.depth:
+            self.trace(self.statename, self.symbol, 1)
 
         self.stepcount += 1
         return True
 
+    def trace(self, statename, symbol, count):
+        self.statetrace.add(statename, symbol, count)
+
+    def event_stream(self):
+        """Returns the EventStream that hands the steps of step() and run()
+        to self.profile, self.recorder and the observers of self.events
+        together, or None if none of them is set"""
+        attached = [o for o in (self.profile, self.recorder) if o is not None]
+        events = self.events
+        if events is None:
+            if not attached:
+                return None
+            events = self.observed
+        events.attached = attached
+        return events
+
+    def compile(self):
+        """Returns the CompiledMachine for the current transition table,
+        rebuilding it only if the table or the set of symbols changed"""
+
+        key = (id(self.states), self.states.version, len(self.symbol_names))
+        if self.compiled_key != key:
+            self.compiled = CompiledMachine(self)
+            # compiling may have assigned codes to new symbols
+            self.compiled_key = (id(self.states), self.states.version, len(self.symbol_names))
+        return self.compiled
+
+    def run(self, max_steps=None, stop_states=(), enter_only=False):
+        """Executes up to max_steps transitions (no limit if None) in a single loop.
+
+        The run stops after a transition into one of stop_states, or if
+        enter_only is set, after a transition from another state into one of
+        stop_states. Returns False if it stopped on an undefined transition,
+        like step().
+
+        self.engine selects the loop: "table" looks transitions up in the
+        compiled table, "codegen" runs Python code generated for the table,
+        "macro" applies cached transitions of whole blocks of cells (see
+        tmmacro), "regops" applies the register operations of machines built
+        by TMBuilder at once on a Tape (see tmregops) and "registers" runs
+        them at the register level between operations (see tmregmachine).
+        An RLETape is run by run_rle(), or with "rules" by the
+        inductive rule engine in tmrules, which switches to an RLETape.
+
+        With self.detect_loops set, a run without max_steps on a Tape or
+        ChunkTape runs probes of the loop in tmcycle between slices of the
+        engine, which stop it and set self.looping when the machine is found
+        to cycle forever (not while recording, profiling or observed).
+
+        While self.events, self.profile or self.recorder is set, the steps of
+        runs are handed in batches to the observers of self.events, counted
+        in the profile (see tmprofile) and recorded to the trace file (see
+        tmtrace), all in the one table loop of tmevents whatever the engine,
+        without looking for cycles or logging undo entries. Runs with the
+        rules engine or on an RLETape then raise ValueError, as they take
+        steps in bulk.
+
+        If self.undo has a memory budget, runs on any tape but an RLETape append every
+        step to it (see tmundo) and use the table loop whatever the engine.
+
+        If self.checkpoints (see tmcheckpoint) or self.milestones (see
+        tmcache) is set, or self.watchers lists other such objects, the run
+        is split into slices of at most their slice() steps and their poll()
+        is called between slices. With a trace depth, a TraceReplay is one
+        of them and fills self.statetrace when the run ends, except on an
+        MmapTape, where the trace only gets the state the run ends in."""
+
+        self.looping = False
+        if self.event_stream() is not None and (self.engine == "rules" or isinstance(self.tape, RLETape)):
+            raise ValueError("runs with the rules engine or on an RLETape cannot be observed, "
+                             "profiled or recorded")
+        c = self.compile()
+        if self.statename not in c.state_ids:
+            return False
+        state = c.state_ids[self.statename]
+        stop = [name in stop_states for name in c.state_names]
+        limit = -1 if max_steps is None else max_steps
+
+        watchers = [w for w in (self.checkpoints, self.milestones) if w is not None] + self.watchers
+        detecting = self.detect_loops and limit == -1 and self.engine != "rules" and \
+            type(self.tape) in (Tape, ChunkTape) and self.event_stream() is None
+        self.cycles.found = None
+        if detecting:
+            self.cycles.begin()
+            watchers.append(self.cycles)
+        replay = None
+        if self.statetrace.depth and not isinstance(self.tape, MmapTape):
+            replay = TraceReplay(self, c)
+            watchers.append(replay)
+        if not watchers:
+            state, steps, halted = self.run_engine(c, state, limit, stop, enter_only)
+            self.end_run(c, state, steps)
+            if steps and self.statetrace.depth:
+                self.trace(self.statename, self.symbol, 1)
+            return not halted
+
+        # run in slices, polling the watchers between them
+        steps = 0
+        while True:
+            part = min(w.slice(self.stepcount) for w in watchers)
+            if limit != -1:
+                part = min(part, limit - steps)
+            start = state
+            leaving = enter_only and stop[start]
+            if leaving:
+                # first leave the stop state the slice starts in, so that a
+                # slice ending in a stop state has entered it
+                leave = [s != start for s in range(len(stop))]
+                state, count, halted = self.run_engine(c, state, part, leave, True)
+            elif detecting and self.cycles.due():
+                part = min(part, self.cycles.window)
+                state, count, halted = self.cycles.probe(self, c, state, part, stop, enter_only,
+                                                         self.undo if self.undo.capacity else None)
+            else:
+                state, count, halted = self.run_engine(c, state, part, stop, enter_only)
+            steps += count
+            self.end_run(c, state, count)
+            stopped = stop[state] and (state != start or not leaving)
+            if halted or stopped or self.looping or steps == limit:
+                break
+            if count != part:
+                if leaving and state != start:
+                    # left the stop state within the slice
+                    continue
+                break
+            for w in watchers:
+                w.poll(self)
+        if replay is not None:
+            replay.finish(self)
+        return not halted
+
+    def stream(self, max_steps=None, stop_states=(), enter_only=False, size=1 << 16):
+        """Runs the machine like run(), as a generator yielding the steps in
+        tmevents.EventBatches of up to size steps as they are taken. The
+        run stops where run() would, or when the generator is closed.
+        self.profile and self.recorder, if set, see the same steps. Raises
+        ValueError like run() with the rules engine or on an RLETape."""
+
+        batches = []
+        events = self.events
+        if events is None:
+            self.events = EventStream([batches.append], size)
+        else:
+            events.observers.append(batches.append)
+        steps = 0
+        try:
+            while max_steps is None or steps < max_steps:
+                part = size if max_steps is None else min(size, max_steps - steps)
+                start = self.stepcount
+                defined = self.run(part, stop_states, enter_only)
+                steps += self.stepcount - start
+                stopped = False
+                if batches:
+                    # the last step, to tell a stop at the end of the slice
+                    last = batches[-1]
+                    before = last.compiled.state_names[last.ids[-1] // last.compiled.nsym]
+                    stopped = self.statename in stop_states and (self.statename != before or not enter_only)
+                yield from batches
+                batches.clear()
+                if not defined or stopped or self.stepcount - start != part or self.looping:
+                    break
+        finally:
+            if events is None:
+                self.events = None
+            else:
+                events.observers.remove(batches.append)
+
+    def run_engine(self, c, state, limit, stop, enter_only):
+        """Runs the loop selected by run(), returns (state, steps, halted)"""
+        if self.engine == "rules":
+            if not isinstance(self.tape, RLETape):
+                self.use_tape("rle")
+            return self.rules.run(self, c, state, limit, stop, enter_only)
+        elif isinstance(self.tape, RLETape):
+            return self.run_rle(c, state, limit, stop, enter_only)
+        elif self.event_stream() is not None:
+            if self.undo.size:
+                self.undo.clear()
+            return self.event_stream().run(self, c, state, limit, stop, enter_only)
+        elif self.undo.capacity:
+            return self.undo.run(self, c, state, limit, stop, enter_only)
+        elif self.engine == "macro":
+            return self.macro.run(self, c, state, limit, stop, enter_only)
+        elif self.engine == "regops" and type(self.tape) is Tape:
+            return self.regops.run(self, c, state, limit, stop, enter_only)
+        elif self.engine == "registers" and type(self.tape) is Tape:
+            return self.registers.run(self, c, state, limit, stop, enter_only)
+        elif self.engine == "codegen":
+            loopstop = [s and not enter_only for s in stop]
+            return c.generated()(self.tape, state, limit, stop, loopstop)
+        else:
+            return self.run_table(c, state, limit, stop, enter_only)
+
+    def end_run(self, c, state, steps):
+        if self.tape.grown:
+            self.tape.trim()
+        self.statename = c.state_names[state]
+        self.stepcount += steps
+
+    def run_table(self, c, state, limit, stop, enter_only):
+        table = c.table
+        nsym = c.nsym
+        tape = self.tape
+        cells = tape.cells
+        pos = tape.pos
+        end = len(cells)
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            transition = table[state * nsym + cells[pos]]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            cells[pos] = write
+            pos += move
+            if pos == end or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+                end = len(cells)
+            steps += 1
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+        tape.pos = pos
+        return state, steps, halted
+
+    def run_rle(self, c, state, limit, stop, enter_only):
+        """The loop for an RLETape. A transition that rewrites the symbol
+        under the head, keeps the state and moves, crosses the whole run of
+        that symbol ahead of the head in one go, with steps counted per cell."""
+
+        table = c.table
+        nsym = c.nsym
+        tape = self.tape
+        left = tape.left
+        right = tape.right
+        cur = tape.cur
+        head = tape.head
+        fill = tape.fill
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            transition = table[state * nsym + cur]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            count = 1
+            if move == 0:
+                cur = write
+            else:
+                if move > 0:
+                    behind, ahead = left, right
+                else:
+                    behind, ahead = right, left
+                if nextstate == state and not (stop[state] and not enter_only):
+                    if ahead and ahead[-1][0] == cur:
+                        run = ahead[-1]
+                        count = run[1] + 1
+                        if limit != -1 and count > limit - steps:
+                            count = limit - steps
+                        if count - 1 == run[1]:
+                            ahead.pop()
+                        else:
+                            run[1] -= count - 1
+                    elif not ahead and cur == fill:
+                        # sweeping out into blank tape
+                        if limit == -1:
+                            self.looping = True
+                            break
+                        count = limit - steps
+                if behind and behind[-1][0] == write:
+                    behind[-1][1] += count
+                else:
+                    behind.append([write, count])
+                if ahead:
+                    run = ahead[-1]
+                    cur = run[0]
+                    if run[1] == 1:
+                        ahead.pop()
+                    else:
+                        run[1] -= 1
+                else:
+                    cur = fill
+                head += move * count
+            steps += count
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+        tape.cur = cur
+        tape.head = head
+        tape.trim()
+        return state, steps, halted
+
     def gc(self):
         """ Returns a list of garbage-collected states"""
 
@@ -166,3 +1516,111 @@ class TuringMachine:
             del self.states[item[0]]
 
         return rv
+
+    def minimize(self):
+        """Merges states that behave the same: for every symbol both have no
+        transition, or both write the same symbol, move the same way and go
+        to states that behave the same. States without any transition are
+        halting states and are never merged, and the start state keeps its
+        name. Returns a dict of each merged state to the state kept for it.
+
+        This is Hopcroft's partition refinement, O(n log n) in the number of
+        states for a fixed set of symbols."""
+
+        symbols = sorted(self.symbols)
+        names = sorted({key[0] for key in self.states} |
+                       {transition.nextstate for transition in self.states.values()} |
+                       {self.start, self.statename})
+        ids = {name: i for i, name in enumerate(names)}
+        n = len(names)
+
+        # the initial blocks group states by what they write and how they
+        # move for each symbol
+        initial = {}
+        for name in names:
+            key = tuple((t.write, MOVES[t.direction]) if t is not None else None
+                        for t in (self.states.get((name, symbol)) for symbol in symbols))
+            if not any(key):
+                key = name
+            initial.setdefault(key, []).append(ids[name])
+        # predecessors[a][q]: the states whose transition on symbols[a] goes to q
+        predecessors = [[[] for _ in range(n)] for _ in symbols]
+        for a, symbol in enumerate(symbols):
+            for name in names:
+                t = self.states.get((name, symbol))
+                if t is not None:
+                    predecessors[a][ids[t.nextstate]].append(ids[name])
+
+        # the blocks are ranges first[b] to end[b] - 1 of elements, and
+        # position[q] is where q is in elements
+        elements = []
+        first = []
+        end = []
+        block = [0] * n
+        for members in initial.values():
+            for q in members:
+                block[q] = len(first)
+            first.append(len(elements))
+            elements.extend(members)
+            end.append(len(elements))
+        position = [0] * n
+        for i, q in enumerate(elements):
+            position[q] = i
+        marked = [0] * len(first)
+
+        pending = set((b, a) for b in range(len(first)) for a in range(len(symbols)))
+        worklist = list(pending)
+        while worklist:
+            splitter = worklist.pop()
+            pending.discard(splitter)
+            b, a = splitter
+            touched = []
+            for q in elements[first[b]:end[b]]:
+                for p in predecessors[a][q]:
+                    c = block[p]
+                    if not marked[c]:
+                        touched.append(c)
+                    # move p to the marked part at the front of its block
+                    i = first[c] + marked[c]
+                    other = elements[i]
+                    elements[i], elements[position[p]] = p, other
+                    position[other] = position[p]
+                    position[p] = i
+                    marked[c] += 1
+            for c in touched:
+                count = marked[c]
+                marked[c] = 0
+                if count == end[c] - first[c]:
+                    continue
+                # the marked states become a new block
+                d = len(first)
+                first.append(first[c])
+                end.append(first[c] + count)
+                marked.append(0)
+                first[c] += count
+                for q in elements[first[d]:end[d]]:
+                    block[q] = d
+                smaller = d if count <= end[c] - first[c] else c
+                for e in range(len(symbols)):
+                    if (c, e) in pending:
+                        splitter = (d, e)
+                    else:
+                        splitter = (smaller, e)
+                    pending.add(splitter)
+                    worklist.append(splitter)
+
+        # keep the start state, the current state, or else the first name of each block
+        keep = [None] * len(first)
+        for name in [self.start, self.statename] + names:
+            if keep[block[ids[name]]] is None:
+                keep[block[ids[name]]] = name
+        merged = {name: keep[block[ids[name]]] for name in names if keep[block[ids[name]]] != name}
+        if merged:
+            table = {key: transition for key, transition in self.states.items() if key[0] not in merged}
+            for key, transition in table.items():
+                if transition.nextstate in merged:
+                    table[key] = transition._replace(nextstate=merged[transition.nextstate])
+            self.states.clear()
+            self.states.update(table)
+            self.statename = merged.get(self.statename, self.statename)
+        return merged
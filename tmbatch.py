@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+# Batch runner for tm.TuringMachine across a pool of processes.
+#
+# Each job is a .tm file, run from its own tape or from one of a list of
+# initial tapes given as the arguments of "#! write", to halting or to a
+# step budget. Jobs run in a ProcessPoolExecutor and a JSON line is printed
+# for each as it finishes:
+#
+#   {"file": ..., "tape": [...] or null, "outcome": ..., "state": ...,
+#    "steps": n, "extent": n, "seconds": s}
+#
+# where outcome is "halted" (in HLT), "undefined transition", "looping" or
+# "budget exhausted" and extent is the largest number of cells spanned by
+# the head and the non-fill cells, sampled every --sample steps. A job that
+# fails has "error" in place of the outcome.
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tm import TuringMachine, TAPES, ENGINES
+
+
+class ExtentSampler:
+    """Keeps the largest tape extent seen between slices of a run, as one
+    of tm.watchers (see TuringMachine.run())"""
+
+    def __init__(self, every):
+        self.every = every
+        self.extent = 0
+
+    def slice(self, stepcount):
+        return self.every
+
+    def poll(self, tm):
+        first, last = tm.tape_bounds()
+        self.extent = max(self.extent, last - first + 1)
+
+
+def run_job(filename, spec=None, max_steps=None, engine="table", tape="bytes",
+            detect_loops=True, sample=1 << 20):
+    """Runs one job and returns its result line as a dict"""
+    begin = time.perf_counter()
+    tm = TuringMachine(trace_depth=0)
+    tm.load(filename, keep_source=False)
+    tm.statename = tm.start
+    if spec is not None:
+        tm.reset_tape()
+        tm.write_tape_spec(spec)
+    tm.engine = engine
+    if tape != "bytes":
+        tm.use_tape(tape)
+    tm.detect_loops = detect_loops
+    sampler = ExtentSampler(sample)
+    tm.watchers.append(sampler)
+    running = tm.run(max_steps)
+    sampler.poll(tm)
+
+    if not running:
+        outcome = "halted" if tm.statename == "HLT" else "undefined transition"
+    elif tm.looping:
+        outcome = "looping"
+    else:
+        outcome = "budget exhausted"
+    return {
+        "file": filename,
+        "tape": spec,
+        "outcome": outcome,
+        "state": tm.statename,
+        "steps": tm.stepcount,
+        "extent": sampler.extent,
+        "seconds": round(time.perf_counter() - begin, 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run Turing machines in parallel, printing results as JSON lines")
+    parser.add_argument("TM_Files", metavar="TM_File", help="Turing Machine file", nargs="+")
+    parser.add_argument("--tapes", metavar="FILE",
+                        help="initial tapes, one per line as the arguments of #! write; "
+                             "every file is run from each (default: the file's own)")
+    parser.add_argument("--steps", type=int, help="step budget per job (default: run to halting)")
+    parser.add_argument("--engine", choices=ENGINES, default="table", help="simulator loop (default table)")
+    parser.add_argument("--tape", choices=sorted(TAPES), default="bytes", help="tape kind (default bytes)")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    parser.add_argument("--sample", type=int, default=1 << 20, metavar="N",
+                        help="steps between samples of the tape extent (default 1048576)")
+    parser.add_argument("--no-loop-detection", action="store_true",
+                        help="do not stop runs without --steps that are found to cycle forever")
+    args = parser.parse_args()
+
+    specs = [None]
+    if args.tapes:
+        with open(args.tapes) as f:
+            specs = [line.split() for line in f if line.strip()]
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        jobs = {pool.submit(run_job, filename, spec, args.steps, args.engine, args.tape,
+                            not args.no_loop_detection, args.sample): (filename, spec)
+                for filename in args.TM_Files for spec in specs}
+        failed = 0
+        for job in as_completed(jobs):
+            try:
+                result = job.result()
+            except Exception as e:
+                filename, spec = jobs[job]
+                result = {"file": filename, "tape": spec, "error": "{}: {}".format(type(e).__name__, e)}
+                failed += 1
+            print(json.dumps(result), flush=True)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+from tm import TuringMachine, ENGINES
+from tmevents import EventStream
+
+
+def bench_step(filename, steps):
+    tm = TuringMachine(trace_depth=0)
+    tm.load(filename, keep_source=False)
+    tm.statename = tm.start
+    begin = time.perf_counter()
+    for _ in range(steps):
+        if not tm.step():
+            break
+    return tm, time.perf_counter() - begin
+
+
+def bench_run(filename, steps, engine, tape="bytes", observer=None):
+    tm = TuringMachine(trace_depth=0)
+    tm.use_tape(tape)
+    tm.load(filename, keep_source=False)
+    tm.statename = tm.start
+    tm.engine = engine
+    if observer is not None:
+        tm.events = EventStream([observer])
+    begin = time.perf_counter()
+    tm.run(steps)
+    return tm, time.perf_counter() - begin
+
+
+def report(name, tm, elapsed, reference):
+    if reference is not None:
+        same = (tm.stepcount, tm.statename, tm.left, tm.right, tm.symbol) == \
+            (reference.stepcount, reference.statename, reference.left, reference.right, reference.symbol)
+    else:
+        same = True
+    print("  {:<10} {:>12} steps {:>8.3f}s {:>14,.0f} steps/s{}".format(
+        name, tm.stepcount, elapsed, tm.stepcount / elapsed if elapsed else 0,
+        "" if same else "  MISMATCH"))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the simulator engines against step()")
+    parser.add_argument("TM_Files", metavar="TM_File", help="Turing Machine file", nargs="+")
+    parser.add_argument("--steps", type=int, default=1000000, help="steps to run (default 1000000)")
+    args = parser.parse_args()
+
+    for fname in args.TM_Files:
+        print(fname)
+        reference, elapsed = bench_step(fname, args.steps)
+        report("step()", reference, elapsed, None)
+        for engine in ENGINES:
+            tm, elapsed = bench_run(fname, args.steps, engine)
+            report(engine, tm, elapsed, reference)
+        tm, elapsed = bench_run(fname, args.steps, "table", "rle")
+        report("rle", tm, elapsed, reference)
+        tm, elapsed = bench_run(fname, args.steps, "table", "chunks")
+        report("chunks", tm, elapsed, reference)
+        # an observer that looks at every batch as a whole
+        tm, elapsed = bench_run(fname, args.steps, "table", observer=lambda batch: max(batch.heads))
+        report("events", tm, elapsed, reference)
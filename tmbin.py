@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+
+# Binary .tmb format for Turing machines, loaded with mmap.
+#
+# The text .tm format stays the source of truth; a .tmb file is converted
+# from it (and back) by this script. After a fixed header come
+#
+#   names: the state names then the symbols, separated by newlines
+#   transitions: 5 little-endian 32 bit integers per transition, the state,
+#       symbol, written symbol, direction character and next state, as
+#       indexes into the names (the direction as its character code)
+#   tape: the symbol indexes of the cells from tape_lo, relative to the head
+#   source: optional, zlib compressed JSON of the source lines of each file
+#       loaded and the (file, line number) of each transition
+#
+# Loading reads the names, transitions and tape through a mmap without
+# parsing lines. The source section is only read when the machine's source
+# or sourcemap is first used, e.g. by "list" in tmdb.
+
+import argparse
+import json
+import mmap
+import struct
+import sys
+import zlib
+from collections.abc import MutableMapping
+
+MAGIC = b"TMB1"
+
+# magic, states, symbols, transitions, start state, fill symbol, tape_lo,
+# tape length, then offset and length of the names and source sections
+HEADER = struct.Struct("<4sIIIIIqQQQQQ")
+
+
+def is_binary(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def write_binary(tm, filename, source=True):
+    """Writes the transition table, start state, fill and tape of tm"""
+    symbols = tm.symbol_names + sorted(tm.symbols - set(tm.symbol_names))
+    symbol_ids = {symbol: i for i, symbol in enumerate(symbols)}
+    states = sorted({tm.start} | {key[0] for key in tm.states} |
+                    {transition.nextstate for transition in tm.states.values()})
+    state_ids = {state: i for i, state in enumerate(states)}
+
+    keys = sorted(tm.states)
+    transitions = []
+    for key in keys:
+        write, direction, nextstate = tm.states[key][:3]
+        transitions += [state_ids[key[0]], symbol_ids[key[1]], symbol_ids[write],
+                        ord(direction), state_ids[nextstate]]
+    first, last = tm.tape_bounds()
+    head = tm.tape.head
+    # the tape codes are the first symbol indexes
+    tape = tm.tape.get_range(head + first, head + last + 1)
+
+    names = "\n".join(states + symbols).encode()
+    packed = struct.pack("<{}I".format(len(transitions)), *transitions)
+    section = b""
+    if source and tm.source:
+        files = {}
+        for (name, lineno), line in tm.source.items():
+            lines = files.setdefault(name, [])
+            lines.extend([""] * (lineno - 1 - len(lines)))
+            lines.append(line)
+        section = zlib.compress(json.dumps({
+            "files": files,
+            "sourcemap": [tm.sourcemap.get(key) for key in keys],
+        }).encode())
+
+    # the transitions start at a multiple of 4 bytes
+    names_padded = names.ljust(len(names) + (-len(names)) % 4, b"\n")
+    source_at = HEADER.size + len(names_padded) + len(packed) + len(tape)
+    header = HEADER.pack(MAGIC, len(states), len(symbols), len(keys), state_ids[tm.start], symbol_ids[tm.fill],
+                         first, len(tape), HEADER.size, len(names), source_at, len(section))
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.write(names_padded)
+        f.write(packed)
+        f.write(tape)
+        f.write(section)
+
+
+class BinaryMachine:
+    """The contents of a .tmb file, see read_binary()"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            magic, nstates, nsymbols, ntransitions, start, fill, self.tape_lo, tape_length, \
+                names_at, names_length, self.source_at, self.source_length = HEADER.unpack_from(m)
+            if magic != MAGIC:
+                raise ValueError("{} is not a binary Turing machine".format(filename))
+            names = m[names_at:names_at + names_length].decode().split("\n")
+            self.states = names[:nstates]
+            self.symbols = names[nstates:]
+            transitions_at = names_at + names_length + (-names_length) % 4
+            # little-endian like write_binary() packs them, whatever the host
+            self.transitions = list(struct.unpack_from("<{}I".format(5 * ntransitions), m, transitions_at))
+            tape_at = transitions_at + 20 * ntransitions
+            self.tape = m[tape_at:tape_at + tape_length]
+        self.start = self.states[start]
+        self.fill = self.symbols[fill]
+
+    def table(self):
+        """Yields ((state, symbol), (write, direction, nextstate)) for each transition"""
+        states = self.states
+        symbols = self.symbols
+        t = iter(self.transitions)
+        for state, symbol, write, direction, nextstate in zip(t, t, t, t, t):
+            yield (states[state], symbols[symbol]), (symbols[write], chr(direction), states[nextstate])
+
+    def tape_symbols(self):
+        return [self.symbols[code] for code in self.tape]
+
+    def read_source(self):
+        """Returns (source, sourcemap) dicts like TuringMachine.source and .sourcemap"""
+        source = {}
+        sourcemap = {}
+        if self.source_length:
+            with open(self.filename, "rb") as f:
+                f.seek(self.source_at)
+                section = json.loads(zlib.decompress(f.read(self.source_length)))
+            for name, lines in section["files"].items():
+                for lineno, line in enumerate(lines, 1):
+                    source[(name, lineno)] = line
+            for (key, transition), location in zip(self.table(), section["sourcemap"]):
+                if location is not None:
+                    sourcemap[key] = tuple(location)
+        return source, sourcemap
+
+    def source_lines(self):
+        """The source lines of every file in load order, or None without a source section"""
+        if not self.source_length:
+            return None
+        source, sourcemap = self.read_source()
+        return [line for key, line in source.items()]
+
+
+def read_binary(filename):
+    return BinaryMachine(filename)
+
+
+class LazySource(MutableMapping):
+    """A dict that adds the entries of a .tmb source section on first use.
+    source and sourcemap share the reading through LazySource.pair()."""
+
+    def __init__(self, data, load):
+        self.data = data
+        self.load = load # called once before any access
+
+    @classmethod
+    def pair(cls, source, sourcemap, machine):
+        """Wraps the source and sourcemap dicts of a TuringMachine that
+        machine (a BinaryMachine) was loaded into"""
+        loaded = []
+
+        def load():
+            if not loaded:
+                lines, locations = machine.read_source()
+                source.update(lines)
+                sourcemap.update(locations)
+                loaded.append(True)
+
+        return cls(source, load), cls(sourcemap, load)
+
+    def loaded(self):
+        if self.load:
+            self.load()
+            self.load = None
+        return self.data
+
+    def __getitem__(self, key):
+        return self.loaded()[key]
+
+    def __setitem__(self, key, value):
+        self.loaded()[key] = value
+
+    def __delitem__(self, key):
+        del self.loaded()[key]
+
+    def __contains__(self, key):
+        return key in self.loaded()
+
+    def __iter__(self):
+        return iter(self.loaded())
+
+    def __len__(self):
+        return len(self.loaded())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert Turing machines between the text and binary formats")
+    parser.add_argument("input", help="a .tm file, or a .tmb file to convert back to text")
+    parser.add_argument("output", help="the converted file")
+    parser.add_argument("--no-source", action="store_true",
+                        help="leave out the source lines (comments) when converting to binary")
+    args = parser.parse_args()
+
+    from tm import TuringMachine
+    if is_binary(args.input):
+        lines = read_binary(args.input).source_lines()
+        if lines is None:
+            # no source lines kept, write the transitions
+            tm = TuringMachine(trace_depth=0)
+            tm.load(args.input)
+            tm.save(args.output)
+            print("{} has no source, only the transition table was written".format(args.input), file=sys.stderr)
+        else:
+            with open(args.output, "w") as f:
+                for line in lines:
+                    f.write(line + "\n")
+    else:
+        tm = TuringMachine(trace_depth=0)
+        tm.load(args.input)
+        write_binary(tm, args.output, not args.no_source)
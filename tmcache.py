@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+# Cache of run results for tm.TuringMachine, keyed by the machine.
+#
+# The key is a SHA-256 of the transition table (with the moves normalized),
+# the state the run starts in, the fill symbol and the tape. Each key has a
+# directory holding milestones, checkpoints (see tmcheckpoint) of the run
+# every so many steps and where runs stopped, and index.json with
+#
+#   "milestones": {steps: [states]} for each milestone, the states known not
+#       to be entered from another state in those steps, so a run with
+#       breakpoints among them can start at the milestone
+#   "outcomes": {"[breakpoints, max_steps]": {"steps": n, "result": ...}}
+#       where a run stopped and why: "breakpoint", "undefined transition",
+#       "looping" or "budget exhausted"
+#
+# Steps are counted from the configuration the key was taken in. When the
+# cache is larger than max_bytes, the keys used least recently are evicted.
+
+import hashlib
+import json
+import os
+import shutil
+from tm import MOVES
+from tmcheckpoint import write_checkpoint, read_checkpoint
+
+
+def machine_key(tm):
+    """The cache key for a run of tm from its current configuration"""
+    bounds = tm.tape.bounds()
+    head = tm.tape.head
+    lo, hi = (head, head) if bounds is None else (min(bounds[0], head), max(bounds[1], head))
+    machine = {
+        "transitions": sorted([*key, transition.write, MOVES[transition.direction], transition.nextstate]
+                              for key, transition in tm.states.items()),
+        "state": tm.statename,
+        "fill": tm.fill,
+        "tape": [tm.symbol_names[code] for code in tm.tape.get_range(lo, hi + 1)],
+        "head": head - lo,
+    }
+    return hashlib.sha256(json.dumps(machine, sort_keys=True).encode()).hexdigest()
+
+
+class MilestoneRecorder:
+    """Adds a milestone to the cache every cache.every steps of a run, as
+    tm.milestones (see TuringMachine.run())"""
+
+    def __init__(self, cache, key, index, base, clear):
+        self.cache = cache
+        self.key = key
+        self.index = index
+        self.base = base # the step count the key was taken at
+        self.clear = clear
+
+    def slice(self, stepcount):
+        return self.cache.every - (stepcount - self.base) % self.cache.every
+
+    def poll(self, tm):
+        steps = tm.stepcount - self.base
+        if steps % self.cache.every == 0:
+            self.cache.add_milestone(self.key, self.index, tm, steps, self.clear)
+
+
+class RunCache:
+    """A cache directory of milestones and outcomes of runs"""
+
+    def __init__(self, directory, max_bytes=1 << 30, every=1 << 24):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.every = every
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0 # steps not run thanks to the cache
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key, name):
+        return os.path.join(self.directory, key, name)
+
+    def load_index(self, key):
+        try:
+            with open(self.path(key, "index.json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"milestones": {}, "outcomes": {}}
+
+    def save_index(self, key, index):
+        """Writes the index, which also marks the key as recently used"""
+        os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+        temporary = self.path(key, "index.json.tmp")
+        with open(temporary, "w") as f:
+            json.dump(index, f)
+        os.replace(temporary, self.path(key, "index.json"))
+
+    def add_milestone(self, key, index, tm, steps, clear):
+        milestones = index["milestones"]
+        if str(steps) in milestones:
+            milestones[str(steps)] = sorted(set(milestones[str(steps)]) | clear)
+        else:
+            os.makedirs(os.path.join(self.directory, key), exist_ok=True)
+            write_checkpoint(tm, self.path(key, "{}.ckpt".format(steps)))
+            milestones[str(steps)] = sorted(clear)
+        self.save_index(key, index)
+        self.evict(key)
+
+    def restore(self, tm, key, steps, base):
+        read_checkpoint(tm, self.path(key, "{}.ckpt".format(steps)), table=False)
+        tm.stepcount = base + steps
+        tm.looping = False
+        self.skipped += steps
+
+    def run(self, tm, breakpoints=(), max_steps=None):
+        """Like tm.run(max_steps, breakpoints, enter_only=True), but starting
+        at the cached outcome or the furthest milestone the breakpoints
+        allow, and recording milestones and the outcome on the way"""
+
+        key = machine_key(tm)
+        index = self.load_index(key)
+        base = tm.stepcount
+        breakpoints = set(breakpoints)
+        outcome_key = json.dumps([sorted(breakpoints), max_steps])
+
+        outcome = index["outcomes"].get(outcome_key)
+        if outcome is not None and os.path.exists(self.path(key, "{}.ckpt".format(outcome["steps"]))):
+            self.hits += 1
+            self.restore(tm, key, outcome["steps"], base)
+            tm.looping = outcome["result"] == "looping"
+            self.save_index(key, index)
+            return outcome["result"] != "undefined transition"
+
+        start = 0
+        for steps, clear in index["milestones"].items():
+            steps = int(steps)
+            if start < steps and (max_steps is None or steps <= max_steps) and breakpoints <= set(clear) \
+                    and os.path.exists(self.path(key, "{}.ckpt".format(steps))):
+                start = steps
+        if start:
+            self.hits += 1
+            self.restore(tm, key, start, base)
+        else:
+            self.misses += 1
+
+        tm.milestones = MilestoneRecorder(self, key, index, base, breakpoints)
+        try:
+            running = tm.run(None if max_steps is None else max_steps - start, breakpoints, enter_only=True)
+        finally:
+            tm.milestones = None
+
+        steps = tm.stepcount - base
+        clear = breakpoints
+        if not running:
+            result = "undefined transition"
+        elif tm.looping:
+            result = "looping"
+        elif steps == max_steps:
+            result = "budget exhausted"
+        else:
+            result = "breakpoint"
+            clear = breakpoints - {tm.statename}
+        index["outcomes"][outcome_key] = {"steps": steps, "result": result}
+        self.add_milestone(key, index, tm, steps, clear)
+        return running
+
+    def evict(self, keep):
+        """Removes the least recently used keys other than keep while the
+        cache is larger than max_bytes"""
+        keys = []
+        total = 0
+        for key in os.listdir(self.directory):
+            size = 0
+            for name in os.listdir(os.path.join(self.directory, key)):
+                size += os.path.getsize(self.path(key, name))
+            total += size
+            if key != keep:
+                used = os.path.getmtime(self.path(key, "index.json")) \
+                    if os.path.exists(self.path(key, "index.json")) else 0
+                keys.append((used, key, size))
+        for used, key, size in sorted(keys):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, key))
+            total -= size
+
+    def stats(self):
+        return "{}: {} hits, {} misses, {} steps skipped".format(
+            self.directory, self.hits, self.misses, self.skipped)
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+
+# Checkpoints of a tm.TuringMachine run.
+#
+# A checkpoint file is one line of JSON holding the run state (state, step
+# count, head, transition table, breakpoints, the files the machine was
+# loaded from) followed by the cells from lo to lo + length - 1 compressed
+# with zlib, as codes into the header's list of symbols. It is written to a
+# temporary file that is then renamed over the checkpoint, so a crash leaves
+# either the old or the new checkpoint.
+
+import json
+import os
+import time
+import zlib
+from tm import Transition
+
+FORMAT = "tm-checkpoint 1"
+
+# steps run between checks of the clock when checkpointing every so many seconds
+SLICE = 1 << 20
+
+
+def write_checkpoint(tm, filename, breakpoints=()):
+    bounds = tm.tape.bounds()
+    head = tm.tape.head
+    lo, hi = (head, head) if bounds is None else (min(bounds[0], head), max(bounds[1], head))
+    cells = tm.tape.get_range(lo, hi + 1)
+    header = {
+        "format": FORMAT,
+        "start": tm.start,
+        "statename": tm.statename,
+        "stepcount": tm.stepcount,
+        "head": head,
+        "lo": lo,
+        "length": len(cells),
+        "fill": tm.fill,
+        "symbols": tm.symbol_names,
+        "transitions": [[*key, *transition[:3]] for key, transition in tm.states.items()],
+        "breakpoints": sorted(breakpoints),
+        "files": sorted(set(name for name, lineno in tm.source if name != "<STDIN>")),
+    }
+    temporary = filename + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(json.dumps(header).encode() + b"\n")
+        f.write(zlib.compress(cells, 1))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+
+def read_checkpoint(tm, filename, load_files=False, table=True):
+    """Restores the run state of tm from a checkpoint and returns its breakpoints.
+
+    With load_files set, the files the machine was loaded from are loaded
+    first (where they still exist) for their source lines. Without table,
+    the transition table of tm is kept."""
+
+    with open(filename, "rb") as f:
+        header = json.loads(f.readline())
+        if header.get("format") != FORMAT:
+            raise ValueError("{} is not a checkpoint".format(filename))
+        cells = zlib.decompress(f.read())
+    if len(cells) != header["length"]:
+        raise ValueError("{} is truncated".format(filename))
+
+    if load_files:
+        for name in header["files"]:
+            if os.path.exists(name):
+                tm.load(name)
+    if table:
+        tm.states.clear()
+        for state, symbol, write, direction, nextstate in header["transitions"]:
+            tm.states[(state, symbol)] = Transition(write, direction, nextstate)
+            tm.symbols.update((symbol, write))
+        tm.start = header["start"]
+    tm.fill = header["fill"]
+    # the codes may differ from the ones this machine assigned
+    codes = bytes(tm.symbol_code(symbol) for symbol in header["symbols"])
+    tm.tape.load(header["lo"], cells.translate(codes.ljust(256, b"\0")), header["head"])
+    tm.statename = header["statename"]
+    tm.stepcount = header["stepcount"]
+    tm.undo.clear()
+    return set(header["breakpoints"])
+
+
+class Checkpointer:
+    """Writes a checkpoint of a TuringMachine every so many steps or
+    seconds. TuringMachine.run() runs in slices of at most slice() steps
+    when tm.checkpoints is set, and calls poll() between them."""
+
+    def __init__(self, filename, steps=None, seconds=None, breakpoints=()):
+        self.filename = filename
+        self.steps = steps
+        self.seconds = seconds
+        self.breakpoints = breakpoints
+        self.last_step = 0
+        self.last_time = time.monotonic()
+        self.written = 0
+
+    def slice(self, stepcount):
+        """The steps to run before the next poll()"""
+        if stepcount < self.last_step:
+            # the machine was restarted
+            self.last_step = stepcount
+        part = self.steps - (stepcount - self.last_step) if self.steps else SLICE
+        if self.seconds:
+            part = min(part, SLICE)
+        return max(part, 1)
+
+    def poll(self, tm):
+        if (self.steps and tm.stepcount - self.last_step >= self.steps) or \
+                (self.seconds and time.monotonic() - self.last_time >= self.seconds):
+            self.write(tm)
+
+    def write(self, tm):
+        write_checkpoint(tm, self.filename, self.breakpoints)
+        self.last_step = tm.stepcount
+        self.last_time = time.monotonic()
+        self.written += 1
+
+    def stats(self):
+        return "{} checkpoints written to {}, last at transition {}".format(
+            self.written, self.filename, self.last_step)
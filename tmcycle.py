@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+
+# Cycle detection for tm.TuringMachine runs without a step limit.
+#
+# The configuration fingerprint is a polynomial hash of the tape relative to
+# the head, F = sum((cell[i] - fill) * B**(i - head)) mod P. A write adds
+# the change in the cell under the head and a move multiplies by B or 1/B,
+# so it is kept up to date in O(1) per step. Together with the state it is
+# compared every step against a configuration saved at steps 1, 2, 4, 8, ...
+# (Brent's algorithm), which finds machines that come back to the same
+# configuration, in place or shifted along the tape.
+#
+# Machines that leave a growing trail behind them never repeat the whole
+# tape. For those, each time the head reaches a new rightmost (leftmost)
+# cell the state and the cells the head has visited since a saved record
+# are compared with the saved record at the same offset. If they match, the
+# machine repeats the same moves shifted along the tape forever.
+#
+# These checks need every step, so TuringMachine.run() does not run the
+# whole of an unbounded run in this loop: it runs probes of a growing number
+# of steps here in between slices of the selected engine, keeping the time
+# in probes to a share of the run. The machine runs forward either way; a
+# cycle is found in the first probe after it has begun that is long enough
+# to hold two or three periods.
+
+import time
+from collections import namedtuple
+
+P = (1 << 61) - 1
+B = 1000003
+B_INVERSE = pow(B, P - 2, P)
+
+# kind is "cycle" or "translated cycle", shift is the head movement of one period
+Cycle = namedtuple("Cycle", ["kind", "start", "period", "shift"])
+
+
+def fingerprint(tape):
+    """The fingerprint of a Tape relative to its head"""
+    bounds = tape.bounds()
+    if bounds is None:
+        return 0
+    f = 0
+    for code in reversed(tape.get_range(bounds[0], bounds[1] + 1)):
+        f = (f * B + code - tape.fill) % P
+    return f * pow(B_INVERSE, tape.head - bounds[0], P) % P
+
+
+def snapshot(tape):
+    """The tape contents relative to the head, for checking a fingerprint match"""
+    bounds = tape.bounds()
+    if bounds is None:
+        return (0, b"")
+    return (bounds[0] - tape.head, tape.get_range(bounds[0], bounds[1] + 1))
+
+
+class CycleDetector:
+    """Runs a TuringMachine on a Tape until it halts, stops or is found to
+    loop, in probes between the slices of the engine as one of the
+    watchers of TuringMachine.run()"""
+
+    def __init__(self, share=0.2, every=1 << 20):
+        self.found = None
+        self.share = share # of the time of a run spent in probes
+        self.every = every # engine steps between chances to probe
+        self.probes = 0
+        self.probe_steps = 0
+        self.begin()
+
+    def begin(self):
+        """Starts the probes of a run"""
+        self.found = None
+        self.clock = time.perf_counter()
+        self.spent = 0.0
+        self.window = 1 << 12
+
+    def slice(self, stepcount):
+        return self.every
+
+    def poll(self, tm):
+        pass
+
+    def due(self):
+        """Whether the run has time left for a probe"""
+        return self.spent <= self.share * (time.perf_counter() - self.clock)
+
+    def probe(self, tm, c, state, limit, stop, enter_only, log=None):
+        """Runs at most limit steps of a probe like run(), each probe twice
+        as long as the last"""
+        begin = time.perf_counter()
+        state, steps, halted = self.run(tm, c, state, limit, stop, enter_only, log)
+        self.spent += time.perf_counter() - begin
+        self.window *= 2
+        self.probes += 1
+        self.probe_steps += steps
+        return state, steps, halted
+
+    def describe(self):
+        if self.found is None:
+            return "no cycle found"
+        if self.found.kind == "cycle":
+            return "cycle of {} steps from step {}".format(self.found.period, self.found.start)
+        return "translated cycle of {} steps moving {:+} cells from step {}".format(
+            self.found.period, self.found.shift, self.found.start)
+
+    def stats(self):
+        return "loop detection: {} probes, {} steps checked, {}".format(
+            self.probes, self.probe_steps, self.describe())
+
+    def run(self, tm, c, state, limit, stop, enter_only, log=None):
+        """The run() loop with cycle detection, returns (state, steps, halted).
+        Sets tm.looping and self.found when the machine loops. Steps are
+        appended to log, a tmundo.UndoLog, if given."""
+
+        self.found = None
+        if log is not None:
+            log.start(c)
+            entries = log.entries
+            capacity = log.capacity
+            i = log.next
+        table = c.table
+        nsym = c.nsym
+        tape = tm.tape
+        cells = tape.cells
+        pos = tape.pos
+        end = len(cells)
+        head = tape.head
+        steps = 0
+        halted = False
+
+        f = fingerprint(tape)
+        # Brent: the configuration saved at the last power of two
+        mark = 1
+        saved_state, saved_f, saved_step, saved_head = state, f, 0, head
+        saved_tape = snapshot(tape)
+
+        # the extent of the head over the run, the saved record and the
+        # extent of the head since the record
+        leftmost = rightmost = head
+        record = None # (direction, state, step, head, copy of the tape)
+        want_record = True
+        low = high = head
+        spent = 0 # step of the last comparison with the record
+        # the last non-blank cells either side as last seen, the tape
+        # ahead of the head is blank once it has passed them
+        blank_left = blank_right = head
+
+        while steps != limit:
+            transition = table[state * nsym + cells[pos]]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            old = cells[pos]
+            if log is not None:
+                entries[i] = state << 10 | old << 2 | move + 1
+                i += 1
+                if i == capacity:
+                    i = 0
+            if write != old:
+                cells[pos] = write
+                f = (f + write - old) % P
+            steps += 1
+            direction = 0
+            if move:
+                pos += move
+                head += move
+                if pos == end or pos < 0:
+                    pos = tape.extend(pos)
+                    cells = tape.cells
+                    end = len(cells)
+                if move > 0:
+                    f = f * B_INVERSE % P
+                    if head > high:
+                        high = head
+                        if head > rightmost:
+                            rightmost = head
+                            direction = 1
+                else:
+                    f = f * B % P
+                    if head < low:
+                        low = head
+                        if head < leftmost:
+                            leftmost = head
+                            direction = -1
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+            if direction:
+                if want_record and (head >= blank_right if direction > 0 else head <= blank_left):
+                    tape.pos = pos
+                    bounds = tape.bounds()
+                    # the record needs blank tape ahead of the head
+                    if bounds is None or (bounds[1] <= head if direction > 0 else bounds[0] >= head):
+                        record = (direction, state, steps, head, tape.copy())
+                        low = high = head
+                        want_record = False
+                    else:
+                        blank_left, blank_right = bounds
+                elif record is not None and record[0] == direction and record[1] == state:
+                    # compare the cells visited since the record at most
+                    # once per that many steps
+                    if steps - spent > high - low:
+                        spent = steps
+                        tape.pos = pos
+                        if self.translated(record, tape, low, high):
+                            self.found = Cycle("translated cycle", record[2] + tm.stepcount,
+                                               steps - record[2], head - record[3])
+                            tm.looping = True
+                            break
+
+            if f == saved_f and state == saved_state:
+                tape.pos = pos
+                if snapshot(tape) == saved_tape:
+                    self.found = Cycle("cycle" if head == saved_head else "translated cycle",
+                                       saved_step + tm.stepcount, steps - saved_step, head - saved_head)
+                    tm.looping = True
+                    break
+            if steps == mark:
+                tape.pos = pos
+                mark *= 2
+                saved_state, saved_f, saved_step, saved_head = state, f, steps, head
+                saved_tape = snapshot(tape)
+                want_record = True
+
+        tape.pos = pos
+        if log is not None:
+            log.next = i
+            log.size = min(log.size + steps, capacity)
+        return state, steps, halted
+
+    @staticmethod
+    def translated(record, tape, low, high):
+        """True if the cells visited since the record are the same as the
+        cells at the record, shifted by the head movement since then"""
+        direction, state, step, record_head, record_tape = record
+        shift = tape.head - record_head
+        if direction > 0:
+            first, last = low, record_head
+        else:
+            first, last = record_head, high
+        return tape.get_range(first + shift, last + shift + 1) == record_tape.get_range(first, last + 1)
@@ -1,9 +1,17 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import argparse
 import traceback
-from tm import TuringMachine
+from tm import TuringMachine, MmapTape, TAPES, ENGINES
+from tmmacro import MacroCache
+from tmundo import UndoLog
+from tmcheckpoint import Checkpointer, write_checkpoint, read_checkpoint
+from tmcache import RunCache
+from tmprofile import Profiler
+from tmtrace import TraceRecorder
+from tmdiagram import SpaceTimeDiagram
 
 class TMDB:
 
@@ -14,6 +22,51 @@ class TMDB:
         self.repeatcommand = False
         self.listsize = 10
         self.stdin_lineno = 1
+        self.branches = {} # name -> TuringMachine, see fork
+        self.branch = "0"
+        self.nextbranch = 1
+        self.cache = None # tmcache.RunCache used by run
+        self.diagram = None # tmdiagram.SpaceTimeDiagram, see diagram
+        self.undo_budget = 64 << 20 # for the undo log, on while the table engine runs
+        self.tm.undo = UndoLog(self.undo_budget)
+
+    def set_engine(self, engine):
+        """Selects engine, turning the undo log off for engines other than
+        the table loop and on again for it"""
+        self.tm.engine = engine
+        if engine == "table":
+            if self.undo_budget and not self.tm.undo.capacity:
+                self.tm.undo = UndoLog(self.undo_budget)
+        elif self.tm.undo.capacity:
+            self.tm.undo = UndoLog()
+            print("The undo log is off with the {} engine, steps it runs cannot be undone "
+                  "(set undo turns it on, running the table loop)".format(engine))
+        self.warn_engine()
+
+    def enable_undo(self):
+        """Turns the undo log on for the reverse commands if it is off.
+        Returns whether it was on."""
+        if self.tm.undo.capacity or not self.undo_budget:
+            return True
+        self.tm.undo = UndoLog(self.undo_budget)
+        print("The undo log was off, steps run from now on can be undone")
+        self.warn_engine()
+        return False
+
+    def warn_engine(self):
+        """Says so when runs will not use the selected engine"""
+        if self.tm.engine == "table":
+            return
+        if self.tm.event_stream() is not None:
+            if self.tm.engine == "rules":
+                print("Runs with the rules engine cannot be profiled or recorded "
+                      "(set profile off and record stop turn that off)")
+            else:
+                print("Runs use the table loop of the event stream while profiling or recording, "
+                      "not the {} engine (set profile off and record stop turn that off)".format(self.tm.engine))
+        elif self.tm.undo.capacity:
+            print("Runs use the table loop while the undo log is on, not the {} engine "
+                  "(set undo 0 turns it off)".format(self.tm.engine))
 
     def repeatcount(self, cmd):
         if len(cmd) == 2 and cmd[1].isnumeric():
@@ -33,51 +86,68 @@ class TMDB:
         cmd = cmd.split()
 
         if cmd[0] in ("s", "step", "si"):
+            self.tm.run(self.repeatcount(cmd), self.breakpoints)
+            self.repeatcommand = True
+            return True
+
+        if cmd[0] in ("n", "next", "ni"):
             for _ in range(self.repeatcount(cmd)):
-                if not self.tm.step():
+                # stop on any change of state
+                if not self.tm.run(None, self.tm.compile().state_ids, enter_only=True):
                     break
                 if self.tm.statename in self.breakpoints or self.tm.looping:
                     break
             self.repeatcommand = True
             return True
 
-        if cmd[0] in ("n", "next", "ni"):
+        if cmd[0] in ("c", "continue"):
             for _ in range(self.repeatcount(cmd)):
-                currentname = self.tm.statename
-                while self.tm.statename == currentname:
-                    if not self.tm.step():
-                        break
-                    if self.tm.looping:
-                        break
+                if not self.tm.run(None, self.breakpoints, enter_only=True):
+                    return True
+                if self.tm.looping:
+                    return True
+            self.repeatcommand = True
+            return True
+
+        if cmd[0] in ("rs", "reverse-step", "rn", "reverse-next", "rc", "reverse-continue") and not self.enable_undo():
+            return False
+
+        if cmd[0] in ("rs", "reverse-step"):
+            if not self.tm.undo.undo(self.tm, self.repeatcount(cmd)):
+                print("No steps to undo")
+            self.repeatcommand = True
+            return True
+
+        if cmd[0] in ("rn", "reverse-next"):
+            for _ in range(self.repeatcount(cmd)):
+                # stop on any change of state
+                if not self.tm.undo.undo(self.tm, -1, self.tm.compile().state_ids, enter_only=True):
+                    print("No steps to undo")
+                    break
                 if self.tm.statename in self.breakpoints:
                     break
             self.repeatcommand = True
             return True
 
-        if cmd[0] in ("c", "continue"):
+        if cmd[0] in ("rc", "reverse-continue"):
             for _ in range(self.repeatcount(cmd)):
-                while True:
-                    currentname = self.tm.statename
-                    while self.tm.statename == currentname:
-                        if not self.tm.step():
-                            return True
-                        if self.tm.looping:
-                            return True
-                    if self.tm.statename in self.breakpoints:
-                        break
+                if not self.tm.undo.undo(self.tm, -1, self.breakpoints, enter_only=True):
+                    print("No steps to undo")
+                    break
             self.repeatcommand = True
             return True
 
         if cmd[0] in ("start",):
-            self.tm.left = []
-            self.tm.right = []
-            self.tm.symbol = self.tm.fill
+            self.tm.reset_tape()
             self.tm.statename = self.tm.start
             self.tm.stepcount = 0
             return True
 
         if cmd[0] in ("run",):
             self.processcommand("start")
+            if self.cache is not None:
+                self.cache.run(self.tm, self.breakpoints)
+                return True
             return self.processcommand("continue")
 
         if cmd[0] in ("jump",):
@@ -85,8 +155,89 @@ class TMDB:
                 print("jump [state]")
                 return False
             self.tm.statename = cmd[1]
+            self.tm.undo.clear()
+            return True
+
+        if cmd[0] in ("fork",):
+            if len(cmd) > 2:
+                print("fork [name]")
+                return False
+            if len(cmd) == 2:
+                name = cmd[1]
+            else:
+                name = str(self.nextbranch)
+                self.nextbranch = self.nextbranch + 1
+            if name == self.branch or name in self.branches:
+                print("Branch {} exists".format(name))
+                return False
+            try:
+                fork = self.tm.fork()
+            except ValueError as e:
+                print(e)
+                return False
+            self.branches[self.branch] = self.tm
+            self.branches[name] = fork
+            print("Branch {} at transition {}".format(name, self.tm.stepcount))
+            return False
+
+        if cmd[0] in ("switch",):
+            if len(cmd) != 2 or cmd[1] not in self.branches:
+                print("switch [{}]".format("|".join(self.branches)))
+                return False
+            self.branches[self.branch] = self.tm
+            self.branch = cmd[1]
+            self.tm = self.branches[cmd[1]]
             return True
 
+        if cmd[0] in ("checkpoint",):
+            if len(cmd) == 2:
+                write_checkpoint(self.tm, cmd[1], self.breakpoints)
+            elif len(cmd) == 1 and self.tm.checkpoints is not None:
+                self.tm.checkpoints.write(self.tm)
+            else:
+                print("checkpoint [filename]")
+            return False
+
+        if cmd[0] in ("profile",):
+            if self.tm.profile is None:
+                print("profiling is off, see set profile")
+            elif len(cmd) == 3 and cmd[1] == "export":
+                self.tm.profile.export(cmd[2])
+            elif len(cmd) == 2 and cmd[1] == "clear":
+                self.tm.profile.clear()
+            else:
+                print("profile [export filename.csv|filename.json] [clear]")
+            return False
+
+        if cmd[0] in ("record",):
+            if len(cmd) == 2 and cmd[1] == "stop":
+                if self.tm.recorder is not None:
+                    self.tm.recorder.close()
+                    self.tm.recorder = None
+            elif len(cmd) == 2:
+                if self.tm.recorder is not None:
+                    self.tm.recorder.close()
+                self.tm.recorder = TraceRecorder(cmd[1])
+                self.warn_engine()
+            else:
+                print("record [filename|stop]")
+            return False
+
+        if cmd[0] in ("diagram",):
+            if len(cmd) == 2 and cmd[1] == "stop":
+                self.stop_diagram()
+            elif 2 <= len(cmd) <= 6 and all(arg.lstrip("-").isnumeric() for arg in cmd[2:]) and len(cmd) != 5:
+                numbers = [int(arg) for arg in cmd[2:]]
+                every = numbers[0] if len(numbers) > 0 else 1
+                cells = numbers[1] if len(numbers) > 1 else 1
+                head = self.tm.tape.head
+                lo, hi = numbers[2:] if len(numbers) > 2 else (head - 400, head + 400)
+                self.start_diagram(SpaceTimeDiagram(cmd[1], lo, hi, every, cells))
+            else:
+                print("diagram [filename.pgm|filename.png] [every] [cells per pixel] [first cell] [last cell + 1]")
+                print("diagram stop")
+            return False
+
         if cmd[0] in ("q", "quit"):
             self.quit = True
             return False
@@ -117,6 +268,57 @@ class TMDB:
             if len(cmd) > 2 and cmd[1] in ("listsize") and cmd[2].isnumeric():
                 self.listsize = int(cmd[2])
                 return False
+            if len(cmd) > 2 and cmd[1] == "engine":
+                if cmd[2] in ENGINES:
+                    self.set_engine(cmd[2])
+                else:
+                    print("set engine [{}]".format("|".join(ENGINES)))
+                return False
+            if len(cmd) > 2 and cmd[1] == "macro":
+                if cmd[2].isnumeric() and (len(cmd) == 3 or cmd[3].isnumeric()):
+                    self.tm.macro = MacroCache(int(cmd[2]), int(cmd[3]) if len(cmd) > 3 else self.tm.macro.capacity)
+                else:
+                    print("set macro [block size] [cache size]")
+                return False
+            if len(cmd) > 2 and cmd[1] == "rules":
+                if len(cmd) == 4 and cmd[2] == "verbose" and cmd[3] in ("on", "off"):
+                    self.tm.rules.verbose = cmd[3] == "on"
+                elif len(cmd) == 4 and cmd[2] == "window" and cmd[3].isnumeric():
+                    self.tm.rules.window = int(cmd[3])
+                    self.tm.rules.clear(len(self.tm.rules.skip))
+                else:
+                    print("set rules [verbose on|off] [window runs]")
+                return False
+            if len(cmd) > 2 and cmd[1] == "loops":
+                if len(cmd) == 3 and cmd[2] in ("on", "off"):
+                    self.tm.detect_loops = cmd[2] == "on"
+                else:
+                    print("set loops [on|off]")
+                return False
+            if len(cmd) > 2 and cmd[1] == "undo":
+                if len(cmd) == 3 and cmd[2].isnumeric():
+                    self.undo_budget = int(cmd[2]) << 20
+                    self.tm.undo = UndoLog(self.undo_budget)
+                    self.warn_engine()
+                else:
+                    print("set undo [budget in MB]")
+                return False
+            if len(cmd) > 2 and cmd[1] == "profile":
+                if len(cmd) == 3 and cmd[2] in ("on", "off"):
+                    if cmd[2] == "off":
+                        self.tm.profile = None
+                    elif self.tm.profile is None:
+                        self.tm.profile = Profiler()
+                        self.warn_engine()
+                else:
+                    print("set profile [on|off]")
+                return False
+            if len(cmd) > 2 and cmd[1] == "tape":
+                if cmd[2] in TAPES:
+                    self.tm.use_tape(cmd[2])
+                else:
+                    print("set tape [{}]".format("|".join(TAPES)))
+                return False
 
         if cmd[0] in ("l", "list"):
             listing = []
@@ -169,7 +371,8 @@ class TMDB:
             return False
 
         if cmd[0] in ("clear"):
-            self.breakpoints = set()
+            # in place, the checkpoints refer to the set
+            self.breakpoints.clear()
             return False
 
         if cmd[0] in ("info"):
@@ -180,16 +383,51 @@ class TMDB:
                         print("{} {}: {}".format(filename, lineno, self.tm.source[(filename, lineno)]))
                     else:
                         print(bp)
+            if cmd[1] in ("macro",):
+                print(self.tm.macro.stats())
+            if cmd[1] in ("rules",):
+                print(self.tm.rules.stats())
+            if cmd[1] in ("loops",):
+                print(self.tm.cycles.stats())
+            if cmd[1] in ("regops",):
+                print(self.tm.regops.stats())
+            if cmd[1] in ("regmachine",):
+                print(self.tm.registers.stats())
+            if cmd[1] in ("undo",):
+                print(self.tm.undo.stats())
+            if cmd[1] in ("checkpoints",) and self.tm.checkpoints is not None:
+                print(self.tm.checkpoints.stats())
+            if cmd[1] in ("cache",) and self.cache is not None:
+                print(self.cache.stats())
+            if cmd[1] in ("diagram",) and self.diagram is not None:
+                print(self.diagram.stats())
+            if cmd[1] in ("record",) and self.tm.recorder is not None:
+                print(self.tm.recorder.stats())
+            if cmd[1] in ("events",) and self.tm.events is not None:
+                print(self.tm.events.stats())
+            if cmd[1] in ("profile",) and self.tm.profile is not None:
+                print(self.tm.profile.stats(int(cmd[2]) if len(cmd) > 2 and cmd[2].isnumeric() else 20))
+            if cmd[1] in ("branches",):
+                self.branches[self.branch] = self.tm
+                for name, tm in self.branches.items():
+                    print("{} {} {} (transitions: {})".format(
+                        "*" if name == self.branch else " ", name, tm.statename, tm.stepcount))
             if cmd[1] in ("registers", "tape"):
-                i = -len(self.tm.left)
+                i, last = self.tm.tape_bounds()
+                cells = self.tm.tape_range(i, last + 1)
+                first = i
+
+                def tape_at(index):
+                    return cells[index - first]
+
                 current_cells = []
-                while i <= len(self.tm.right):
+                while i <= last:
                     # look for a run
                     for pattern_length in (1,2,3,4,5):
                         run_length = 1
-                        while i + run_length*pattern_length < len(self.tm.right):
+                        while i + run_length*pattern_length < last:
                             for pattern_i in range(pattern_length):
-                                if self.tm.tape_at(i + pattern_i) != self.tm.tape_at(i + pattern_i + run_length*pattern_length):
+                                if tape_at(i + pattern_i) != tape_at(i + pattern_i + run_length*pattern_length):
                                     break
                             else:
                                 run_length = run_length + 1
@@ -198,7 +436,7 @@ class TMDB:
                         if run_length >= 10:
                             break
                     else:
-                        current_cells.append(self.tm.tape_at(i))
+                        current_cells.append(tape_at(i))
                         i = i + 1
                         continue
 
@@ -208,7 +446,7 @@ class TMDB:
 
                     current_cells = []
                     for pattern_i in range(pattern_length):
-                        current_cells.append(self.tm.tape_at(i + pattern_i))
+                        current_cells.append(tape_at(i + pattern_i))
 
                     print("{:>10} x {}".format(run_length, "".join(current_cells)))
                     current_cells = []
@@ -222,6 +460,20 @@ class TMDB:
         return True # by default print information
 
 
+    def start_diagram(self, diagram):
+        self.stop_diagram()
+        self.diagram = diagram
+        self.tm.watchers.append(diagram)
+        diagram.add(self.tm)
+
+    def stop_diagram(self):
+        if self.diagram is not None:
+            for tm in [self.tm, *self.branches.values()]:
+                if self.diagram in tm.watchers:
+                    tm.watchers.remove(self.diagram)
+            self.diagram.close()
+            self.diagram = None
+
     def mainloop(self):
         lastcommand = ""
 
@@ -235,16 +487,13 @@ class TMDB:
             except Exception:
                 traceback.print_exc()
                 printstatus = True
+            if self.diagram is not None:
+                # runs stopping on a sampled step do not poll
+                self.diagram.poll(self.tm)
 
             if printstatus:
-                if len(self.tm.left) >= 35:
-                    left = "".join(self.tm.left[-35:])
-                else:
-                    left = (("0" * 35) + "".join(self.tm.left))[-35:]
-                if len(self.tm.right) >= 35:
-                    right = "".join(reversed(self.tm.right[-35:]))
-                else:
-                    right = ("".join(reversed(self.tm.right)) + ("0" * 35))[:35]
+                left = "".join(self.tm.tape_range(-35, 0))
+                right = "".join(self.tm.tape_range(1, 36))
                 print("{}[{}]{}".format(left,self.tm.symbol,right))
                 if (self.tm.statename, self.tm.symbol) in self.tm.states:
                     state = self.tm.states[(self.tm.statename, self.tm.symbol)]
@@ -252,6 +501,8 @@ class TMDB:
                         *self.tm.states[(self.tm.statename, self.tm.symbol)]))
                     if self.tm.statename in self.breakpoints:
                         print(f"Breakpoint (transitions: {self.tm.stepcount})")
+                    elif self.tm.looping and self.tm.cycles.found:
+                        print("looping detected: {}".format(self.tm.cycles.describe()))
                     elif self.tm.looping:
                         print("looping detected")
 
@@ -268,10 +519,97 @@ import argparse
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Debugger for Turing machines")
     parser.add_argument("TM_Files", metavar="TM_File", help="Turing Machine file", nargs="*")
+    parser.add_argument("--engine", choices=ENGINES, default="table",
+                        help="simulator loop used by step, next and continue")
+    parser.add_argument("--macro-block", type=int, default=32,
+                        help="block size for the macro engine")
+    parser.add_argument("--tape", choices=TAPES, default="bytes",
+                        help="tape representation, rle crosses runs of a symbol in one step, "
+                        "mmap keeps the cells in a file")
+    parser.add_argument("--tape-file", metavar="FILE",
+                        help="file for the mmap tape (default: a temporary file)")
+    parser.add_argument("--rules-window", type=int, default=16,
+                        help="runs on each side of the head checked by the rules engine")
+    parser.add_argument("--rules-verbose", action="store_true",
+                        help="report rules as the rules engine proves and applies them")
+    parser.add_argument("--undo-budget", type=int, metavar="MB",
+                        help="memory for the undo log of reverse-step, reverse-next and reverse-continue, "
+                        "which only undo steps run while it is on (default: 64 MB, on with --engine table), "
+                        "0 to disable")
+    parser.add_argument("--no-loop-detection", action="store_true",
+                        help="do not check runs without a step limit for cycles")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="write the run state to FILE every so many steps or seconds")
+    parser.add_argument("--checkpoint-steps", type=int, metavar="N",
+                        help="steps between checkpoints")
+    parser.add_argument("--checkpoint-seconds", type=float, metavar="T",
+                        help="seconds between checkpoints (default 300 if --checkpoint-steps is not given)")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="directory caching where run stops and milestones on the way")
+    parser.add_argument("--cache-size", type=int, default=1024, metavar="MB",
+                        help="size of the cache directory before the least recently used machines are evicted")
+    parser.add_argument("--cache-every", type=int, default=1 << 24, metavar="N",
+                        help="steps between milestones in the cache")
+    parser.add_argument("--profile", action="store_true",
+                        help="count the steps taken from each transition, see info profile")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record the execution trace to FILE, see tmtrace.py")
+    parser.add_argument("--diagram", metavar="FILE",
+                        help="draw a space-time diagram of the run to FILE (.pgm or .png)")
+    parser.add_argument("--diagram-every", type=int, default=1, metavar="N",
+                        help="steps between the rows of the diagram")
+    parser.add_argument("--diagram-cells", type=int, default=1, metavar="N",
+                        help="cells per pixel of the diagram")
+    parser.add_argument("--diagram-window", metavar="LO:HI", default="-400:400",
+                        help="cells LO to HI - 1 drawn in the diagram (default -400:400)")
+    parser.add_argument("--no-source", action="store_true",
+                        help="do not keep the lines of the TM files, for large machines (list shows no source)")
+    parser.add_argument("--resume", action="store_true",
+                        help="restart from the checkpoint FILE, loading the TM files it was made from "
+                        "if none are given")
 
     args = parser.parse_args()
+    if (args.profile or args.record) and (args.engine == "rules" or args.tape == "rle"):
+        parser.error("--profile and --record cannot observe runs with --engine rules or --tape rle")
 
     tmdb = TMDB()
+    tmdb.set_engine(args.engine)
+    tmdb.tm.macro = MacroCache(args.macro_block)
+    if args.tape == "mmap" and args.tape_file:
+        tmdb.tm.tape = MmapTape(tmdb.tm.tape.fill, args.tape_file)
+    else:
+        tmdb.tm.use_tape(args.tape)
+    tmdb.tm.rules.window = args.rules_window
+    tmdb.tm.rules.verbose = args.rules_verbose
+    tmdb.tm.detect_loops = not args.no_loop_detection
+    if args.undo_budget is not None:
+        tmdb.undo_budget = args.undo_budget << 20
+        tmdb.tm.undo = UndoLog(tmdb.undo_budget)
+    if args.profile:
+        tmdb.tm.profile = Profiler()
+    if args.record:
+        tmdb.tm.recorder = TraceRecorder(args.record)
+    if args.undo_budget is not None or args.profile or args.record:
+        tmdb.warn_engine()
     for fname in args.TM_Files:
-        tmdb.tm.load(fname)
+        tmdb.tm.load(fname, keep_source=not args.no_source)
+    if args.checkpoint:
+        if args.resume and os.path.exists(args.checkpoint):
+            tmdb.breakpoints.update(read_checkpoint(tmdb.tm, args.checkpoint, not args.TM_Files))
+            print("Resumed at transition {}".format(tmdb.tm.stepcount))
+        seconds = args.checkpoint_seconds
+        if seconds is None and args.checkpoint_steps is None:
+            seconds = 300
+        tmdb.tm.checkpoints = Checkpointer(args.checkpoint, args.checkpoint_steps, seconds, tmdb.breakpoints)
+        tmdb.tm.checkpoints.last_step = tmdb.tm.stepcount
+    elif args.resume:
+        parser.error("--resume needs --checkpoint")
+    if args.cache:
+        tmdb.cache = RunCache(args.cache, args.cache_size << 20, args.cache_every)
+    if args.diagram:
+        lo, hi = (int(cell) for cell in args.diagram_window.split(":"))
+        tmdb.start_diagram(SpaceTimeDiagram(args.diagram, lo, hi, args.diagram_every, args.diagram_cells))
     tmdb.mainloop()
+    if tmdb.tm.recorder is not None:
+        tmdb.tm.recorder.close()
+    tmdb.stop_diagram()
@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+# Space-time diagrams of tm.TuringMachine runs, streamed to a PGM or PNG file.
+#
+# Each row of the image is the tape at one sampled step, time going down.
+# Only a window of absolute cells lo to hi - 1 is drawn, each pixel covering
+# a group of cells, so a row is written as soon as it is sampled and memory
+# stays proportional to the width. The fill symbol is white, other symbols
+# darker by their code (the darkest in a group is drawn) and the head grey.
+# The height is not known until the diagram is closed, so it is written as
+# a placeholder and patched then.
+
+import struct
+import zlib
+
+HEAD = 128
+
+
+class SpaceTimeDiagram:
+    """Writes a row every `every` steps as one of tm.watchers (see
+    TuringMachine.run()), and on add() for steps taken otherwise"""
+
+    def __init__(self, filename, lo, hi, every=1, cells=1):
+        self.filename = filename
+        self.lo = lo
+        self.hi = hi
+        self.every = every
+        self.cells = cells
+        self.width = (hi - lo + cells - 1) // cells
+        self.rows = 0
+        self.last = None # step count of the last row
+        self.png = filename.endswith(".png")
+        self.file = open(filename, "wb")
+        if self.png:
+            self.file.write(b"\x89PNG\r\n\x1a\n")
+            self.chunk(b"IHDR", self.ihdr())
+            self.compressor = zlib.compressobj(6)
+            self.pending = bytearray()
+        else:
+            self.file.write(self.pgm_header())
+
+    def pgm_header(self):
+        # the height is padded so the header keeps its length when patched
+        return "P5\n{} {:>10}\n255\n".format(self.width, self.rows).encode()
+
+    def ihdr(self):
+        # 8 bit greyscale
+        return struct.pack(">IIBBBBB", self.width, self.rows, 8, 0, 0, 0, 0)
+
+    def chunk(self, kind, data):
+        self.file.write(struct.pack(">I", len(data)) + kind + data +
+                        struct.pack(">I", zlib.crc32(kind + data)))
+
+    def slice(self, stepcount):
+        return self.every - stepcount % self.every
+
+    def poll(self, tm):
+        if tm.stepcount % self.every == 0:
+            self.add(tm)
+
+    def add(self, tm):
+        """Writes the row for the current configuration, once per step count"""
+        if self.last == tm.stepcount:
+            return
+        self.last = tm.stepcount
+        codes = tm.tape.get_range(self.lo, self.hi)
+        fill = tm.tape.fill
+        nsym = max(len(tm.symbol_names), 2)
+        shades = bytes(255 if code == fill else 255 * max(nsym - 1 - code, 0) // nsym for code in range(256))
+        pixels = codes.translate(shades)
+        if self.cells > 1:
+            pixels = bytes(min(pixels[i:i + self.cells]) for i in range(0, len(pixels), self.cells))
+        head = tm.tape.head
+        if self.lo <= head < self.hi:
+            pixels = bytearray(pixels)
+            pixels[(head - self.lo) // self.cells] = HEAD
+        self.rows += 1
+        if self.png:
+            self.pending += self.compressor.compress(b"\0" + bytes(pixels))
+            if len(self.pending) >= 1 << 16:
+                self.chunk(b"IDAT", bytes(self.pending))
+                self.pending = bytearray()
+        else:
+            self.file.write(pixels)
+
+    def close(self):
+        """Finishes the file and patches in the height"""
+        if self.png:
+            self.pending += self.compressor.flush()
+            self.chunk(b"IDAT", bytes(self.pending))
+            self.chunk(b"IEND", b"")
+            self.file.seek(8)
+            self.chunk(b"IHDR", self.ihdr())
+        else:
+            self.file.seek(0)
+            self.file.write(self.pgm_header())
+        self.file.close()
+
+    def stats(self):
+        return "diagram {}: {} rows of {} pixels, cells {} to {}, a row every {} steps".format(
+            self.filename, self.rows, self.width, self.lo, self.hi - 1, self.every)
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+# Batched event streams of tm.TuringMachine runs, for observers.
+#
+# While tm.events, tm.profile or tm.recorder is set, run() uses the table
+# loop here, which appends the transition id (state * nsym + symbol, the
+# index into the compiled table) and the head of every step to arrays, and
+# step() appends its transition. Every `size` steps, and at the end of each
+# run, the arrays are handed to the observers as an EventBatch, so an
+# observer costs one call per batch and can work on whole arrays (e.g.
+# numpy.frombuffer(batch.ids, "int64")). The profiler (tmprofile) and the
+# trace recorder (tmtrace) are observers like any other, so any of them are
+# served together by the one loop. The writes, moves and next states of a
+# batch are looked up from the ids through the compiled table. Runs without
+# observers are not affected.
+
+from array import array
+
+
+class EventBatch:
+    """The steps from step count first on, as packed arrays"""
+
+    def __init__(self, c, first, ids, heads):
+        self.compiled = c # the CompiledMachine the ids index
+        self.first = first # step count before the first step
+        self.ids = ids # array('q') of transition ids
+        self.heads = heads # array('q') of the cell the head is on before each step
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, column, typecode):
+        table = self.compiled.table
+        return array(typecode, [table[i][column] for i in self.ids])
+
+    def states(self):
+        """array('q') of the state id of each step"""
+        nsym = self.compiled.nsym
+        return array('q', [i // nsym for i in self.ids])
+
+    def symbols(self):
+        """array('B') of the symbol code read by each step"""
+        nsym = self.compiled.nsym
+        return array('B', [i % nsym for i in self.ids])
+
+    def writes(self):
+        """array('B') of the symbol code written by each step, at heads"""
+        return self.lookup(0, 'B')
+
+    def moves(self):
+        """array('b') of the head move of each step, -1, 0 or 1"""
+        return self.lookup(1, 'b')
+
+    def next_states(self):
+        """array('q') of the state id after each step"""
+        return self.lookup(2, 'q')
+
+    def events(self):
+        """Yields (step, state, symbol, write, move, next state, head) by
+        name for each step, the slow way"""
+        c = self.compiled
+        for n, (i, head) in enumerate(zip(self.ids, self.heads)):
+            write, move, nextstate = c.table[i]
+            yield (self.first + n + 1, c.state_names[i // c.nsym], c.symbol_names[i % c.nsym],
+                   c.symbol_names[write], move, c.state_names[nextstate], head)
+
+
+class EventStream:
+    """Hands the steps of the runs of a TuringMachine, while it is
+    tm.events, to each of observers as EventBatches of up to size steps.
+
+    An observer is a callable taking an EventBatch. If it also has a
+    begin(tm, c, state, step) method, that is called where each batch
+    starts, before its steps are taken (the TraceRecorder keyframes the
+    tape there)."""
+
+    def __init__(self, observers=(), size=1 << 16):
+        self.observers = list(observers)
+        self.attached = [] # tm.profile and tm.recorder, see TuringMachine.event_stream()
+        self.size = size
+        self.compiled = None
+        self.first = 0
+        self.ids = array('q')
+        self.heads = array('q')
+        self.steps = 0
+        self.batches = 0
+
+    def flush(self):
+        """Hands the steps collected so far to the observers"""
+        if self.ids:
+            batch = EventBatch(self.compiled, self.first, self.ids, self.heads)
+            self.batches += 1
+            self.ids = array('q')
+            self.heads = array('q')
+            for observer in self.attached + self.observers:
+                observer(batch)
+
+    def begin(self, tm, c, state, step):
+        """Starts a batch at step count step in state id state"""
+        self.flush()
+        self.compiled = c
+        self.first = step
+        for observer in self.attached + self.observers:
+            if hasattr(observer, "begin"):
+                observer.begin(tm, c, state, step)
+
+    def step(self, tm, c, index):
+        """Adds a transition taken by step()"""
+        self.begin(tm, c, index // c.nsym, tm.stepcount)
+        self.ids.append(index)
+        self.heads.append(tm.tape.head)
+        self.steps += 1
+        self.flush()
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop, collecting every step"""
+
+        steps = 0
+        while True:
+            self.begin(tm, c, state, tm.stepcount + steps)
+            part = self.size if limit == -1 else min(self.size, limit - steps)
+            state, count, halted = self.loop(tm, c, state, part, stop, enter_only)
+            steps += count
+            self.flush()
+            if halted or count != part or steps == limit:
+                break
+        self.steps += steps
+        return state, steps, halted
+
+    def loop(self, tm, c, state, limit, stop, enter_only):
+        ids = self.ids
+        heads = self.heads
+        table = c.table
+        nsym = c.nsym
+        tape = tm.tape
+        cells = tape.cells
+        pos = tape.pos
+        origin = tape.origin
+        end = len(cells)
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            index = state * nsym + cells[pos]
+            transition = table[index]
+            if transition is None:
+                halted = True
+                break
+            ids.append(index)
+            heads.append(pos - origin)
+            write, move, nextstate = transition
+            cells[pos] = write
+            pos += move
+            if pos == end or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+                origin = tape.origin
+                end = len(cells)
+            steps += 1
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+        tape.pos = pos
+        return state, steps, halted
+
+    def stats(self):
+        return "event stream: {} steps in {} batches to {} observers".format(
+            self.steps, self.batches, len(self.attached) + len(self.observers))
@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+# Block macro-machine engine for tm.TuringMachine
+#
+# The tape is viewed as blocks of k cells, block b holding absolute cells
+# b*k to b*k + k - 1. A macro transition runs the machine from a state and
+# head offset inside a block until the head leaves the block, and is cached
+# by (state, block contents, offset). Offset 0 is entering from the left,
+# offset k - 1 entering from the right.
+
+from collections import OrderedDict, namedtuple
+
+# end is the head offset afterwards: -1 or k if the head left the block,
+# otherwise the machine halted inside it. visited is the set of states
+# transitioned to, so runs with stop states can tell if they must single-step.
+MacroTransition = namedtuple("MacroTransition", ["block", "end", "state", "steps", "visited"])
+
+
+def simulate_block(table, nsym, block, offset, state, max_steps, stop=None, enter_only=False):
+    """Runs one block until the head leaves it, the machine halts, max_steps
+    have been taken or a stop state is reached.
+
+    Returns (block, end, state, steps, visited, halted, stopped)"""
+
+    cells = bytearray(block)
+    k = len(cells)
+    pos = offset
+    steps = 0
+    visited = set()
+    halted = False
+    stopped = False
+    while 0 <= pos < k and steps != max_steps:
+        transition = table[state * nsym + cells[pos]]
+        if transition is None:
+            halted = True
+            break
+        write, move, nextstate = transition
+        cells[pos] = write
+        pos += move
+        steps += 1
+        visited.add(nextstate)
+        if stop is not None and stop[nextstate] and (nextstate != state or not enter_only):
+            state = nextstate
+            stopped = True
+            break
+        state = nextstate
+    return bytes(cells), pos, state, steps, visited, halted, stopped
+
+
+class MacroCache:
+    """Bounded LRU cache of macro transitions for blocks of k cells"""
+
+    def __init__(self, block=32, capacity=100000):
+        self.block = block
+        self.capacity = capacity
+        self.transitions = OrderedDict()
+        self.compiled = None
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.macro_steps = 0 # steps taken by cached macro transitions
+        self.single_steps = 0 # steps simulated one at a time
+
+    def lookup(self, c, state, block, offset):
+        key = (state, block, offset)
+        try:
+            transition = self.transitions[key]
+        except KeyError:
+            self.misses += 1
+            new_block, end, new_state, steps, visited, halted, stopped = simulate_block(
+                c.table, c.nsym, block, offset, state, 64 * len(block) * len(c.state_names))
+            if 0 <= end < len(block) and not halted:
+                # the machine loops inside the block
+                transition = None
+            else:
+                transition = MacroTransition(new_block, end, new_state, steps, frozenset(visited))
+            self.transitions[key] = transition
+            if len(self.transitions) > self.capacity:
+                self.transitions.popitem(last=False)
+                self.evictions += 1
+            return transition
+        self.hits += 1
+        self.transitions.move_to_end(key)
+        return transition
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop for the macro engine, returns (state, steps, halted)"""
+
+        if self.compiled is not c:
+            self.transitions.clear()
+            self.compiled = c
+        k = self.block
+        tape = tm.tape
+        stopset = frozenset(i for i, s in enumerate(stop) if s)
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            head = tape.head
+            start = head // k * k
+            first = start + tape.origin
+            if first < 0 or first + k > len(tape.cells):
+                tape.ensure(start, start + k)
+                first = start + tape.origin
+            # a block across two chunks of a ChunkTape
+            straddles = first < 0 or first + k > len(tape.cells)
+            if straddles:
+                old_block = tape.get_range(start, start + k)
+            else:
+                old_block = bytes(tape.cells[first:first + k])
+            transition = self.lookup(c, state, old_block, head - start)
+            if transition is not None and (limit == -1 or transition.steps <= limit - steps) \
+                    and stopset.isdisjoint(transition.visited):
+                block, end, state, count = transition[:4]
+                # the undefined transition only runs if the limit leaves a step for it
+                halted = 0 <= end < k and (limit == -1 or count < limit - steps)
+                stopped = False
+                self.macro_steps += count
+            else:
+                block, end, state, count, visited, halted, stopped = simulate_block(
+                    c.table, c.nsym, old_block, head - start, state,
+                    (64 * k) if limit == -1 else min(limit - steps, 64 * k), stop, enter_only)
+                self.single_steps += count
+            if block != old_block:
+                if straddles:
+                    tape.set_range(start, block)
+                else:
+                    tape.cells[first:first + k] = block
+            tape.pos = start + end + tape.origin
+            if not 0 <= tape.pos < len(tape.cells):
+                tape.extend(tape.pos)
+            steps += count
+            if halted or stopped:
+                break
+
+        return state, steps, halted
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return ("block size {}, {} cached of {}, {} hits, {} misses ({:.1%} hit rate), {} evictions\n"
+                "{} steps by macro transitions, {} steps simulated singly").format(
+                    self.block, len(self.transitions), self.capacity, self.hits, self.misses,
+                    self.hits / lookups if lookups else 0, self.evictions,
+                    self.macro_steps, self.single_steps)
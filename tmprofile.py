@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+# Execution profile of tm.TuringMachine runs.
+#
+# While tm.profile is set, it observes the steps of step() and run() in the
+# batches of tmevents, alongside any other observers, and counts the steps
+# taken from each (state, symbol) in an array indexed like the compiled
+# table. Counts for an older compiled table are kept by name when the table
+# changes.
+
+import csv
+import json
+from array import array
+from collections import Counter
+
+# framework phases by state name prefix, see TMBuilder; other states whose
+# names begin with a digit are "framework", the rest "DAG"
+PHASES = ("0a", "0b", "1b", "2b", "2c", "2e", "3.", "4.dispatch", "5.root", "6.break", "6.continue")
+
+
+def phase(name):
+    for prefix in PHASES:
+        if name.startswith(prefix):
+            return prefix
+    return "framework" if name[:1].isdigit() else "DAG"
+
+
+class Profiler:
+    """Per-transition step counters"""
+
+    def __init__(self):
+        self.counts = array('q')
+        self.compiled = None # CompiledMachine that counts is indexed for
+        self.older = {} # (state, symbol) -> steps counted for earlier tables
+
+    def start(self, c):
+        """Prepares the counters for a run of CompiledMachine c"""
+        if self.compiled is not c:
+            self.fold()
+            self.counts = array('q', bytes(8 * len(c.table)))
+            self.compiled = c
+
+    def fold(self):
+        """Moves the counts into self.older, by name"""
+        for key, count in self.current().items():
+            self.older[key] = self.older.get(key, 0) + count
+        self.counts = array('q')
+        self.compiled = None
+
+    def current(self):
+        c = self.compiled
+        return {(c.state_names[i // c.nsym], c.symbol_names[i % c.nsym]): count
+                for i, count in enumerate(self.counts) if count}
+
+    def transitions(self):
+        """Returns {(state, symbol): steps} for every transition taken"""
+        counts = dict(self.older)
+        if self.compiled is not None:
+            for key, count in self.current().items():
+                counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def clear(self):
+        self.counts = array('q', bytes(len(self.counts) * 8))
+        self.older = {}
+
+    def __call__(self, batch):
+        """Counts the steps of a tmevents.EventBatch"""
+        self.start(batch.compiled)
+        counts = self.counts
+        for index, count in Counter(batch.ids).items():
+            counts[index] += count
+
+    def top(self, n):
+        """The n transitions taken most, as ((state, symbol), steps)"""
+        return sorted(self.transitions().items(), key=lambda item: (-item[1], item[0]))[:n]
+
+    def phases(self):
+        """Returns {phase: steps}, see phase()"""
+        totals = {}
+        for (state, symbol), count in self.transitions().items():
+            totals[phase(state)] = totals.get(phase(state), 0) + count
+        return totals
+
+    def export(self, filename):
+        """Writes the counts as JSON if filename ends in .json, otherwise as CSV"""
+        rows = sorted(self.transitions().items())
+        with open(filename, "w", newline="") as f:
+            if filename.endswith(".json"):
+                json.dump([{"state": state, "symbol": symbol, "steps": count, "phase": phase(state)}
+                           for (state, symbol), count in rows], f, indent=1)
+            else:
+                writer = csv.writer(f)
+                writer.writerow(["state", "symbol", "steps", "phase"])
+                for (state, symbol), count in rows:
+                    writer.writerow([state, symbol, count, phase(state)])
+
+    def stats(self, n=20):
+        counts = self.transitions()
+        total = sum(counts.values())
+        lines = ["profile: {} steps over {} transitions".format(total, len(counts))]
+        for (state, symbol), count in self.top(n):
+            lines.append("  {:>14} {:6.2f}%  {} {}".format(count, 100 * count / total, state, symbol))
+        lines.append("by phase:")
+        for name, count in sorted(self.phases().items(), key=lambda item: -item[1]):
+            lines.append("  {:>14} {:6.2f}%  {}".format(count, 100 * count / total, name))
+        return "\n".join(lines)
@@ -0,0 +1,344 @@
+#!/usr/bin/python3
+
+# Register machine fast-forward for machines built by TMBuilder.
+#
+# On entering a register operation (2b.reg.<k>.inc or .dec) the tape of a
+# TMBuilder machine is, see TMBuilder.framework:
+#
+#   [ PC ]00[ -1 register ]0[ register 0 ]0[ register 1 ]0 ... [ last ]00
+#          ^ head
+#
+# with every register a run of value + 1 ones and only blank cells after the
+# last one. decode() splits it into the cells up to the 0 after the -1
+# register, which hold the PC and are all the decision tree and the rest of
+# the framework ever read, and the registers as Python ints. The engine then
+# runs at the register level: the operation is applied to the ints with its
+# step count in closed form (the same as tmregops, the head walks from the
+# entry to the end of the register file and back, or to the register and back
+# when a decnz fails), and the run from its return to the next operation is
+# looked up by the cells left of the register file, simulated once and
+# cached. A cycle that would take the run past its step limit or through a
+# stop state is handed back to the TM level: the tape is encoded again, which
+# gives exactly the tape stepping would have, and the regops loop takes the
+# run from there. A later run that starts inside that operation finishes it
+# in the regops loop and decodes again at the entry of the next one.
+
+import re
+
+
+def operation_steps(kind, k, ones, cells, depth):
+    """Returns (steps, failed) of register operation kind ("inc" or "dec",
+    a decnz) on register k, entered depth cells left of register 0 with the
+    register file holding ones (value + 1 for each register) in cells cells,
+    or None for a register past the end of the file. The head walks from
+    the entry to the end of the register file and back, or to register k
+    and back when a decnz fails, see tmregops.RegisterOps.apply(); a
+    register just past the end is added holding 0, by inc as well."""
+
+    n = len(ones)
+    if k > n:
+        return None
+    if kind == "inc":
+        return 2 * (depth + cells) + (2 if k < n else 4), False
+    if k == n:
+        return 2 * (depth + cells) + 2, True
+    if ones[k] == 1:
+        return 2 * (depth + sum(ones[:k]) + k) + 4, True
+    return 2 * (depth + cells) + 2, False
+
+
+class RegisterFile:
+    """A TMBuilder machine decoded at the entry of a register operation"""
+
+    def __init__(self, lo, left, head, state, ones):
+        self.lo = lo # absolute cell of left[0]
+        self.left = left # bytes: the cells up to the 0 after the -1 register
+        self.head = head
+        self.state = state # the entry state id
+        self.ones = ones # the number of ones in each register, value + 1
+        self.cells = sum(ones) + len(ones) # length of the register file
+
+    @property
+    def start(self):
+        """The absolute cell register 0 starts at"""
+        return self.lo + len(self.left)
+
+    def values(self):
+        return [n - 1 for n in self.ones]
+
+
+class RegisterMachine:
+    """The "registers" engine of TuringMachine.run(), on top of tm.regops"""
+
+    def __init__(self):
+        self.compiled = None
+        self.cycles = {} # (lo, left, head, final state) -> next operation, see cycle()
+        self.interned = {}
+        self.last = None # the RegisterFile of the last run
+        self.profile = None # collects the operations run, see TMBuilder.RegisterProfile
+        self.ops = 0
+        self.skipped = 0
+        self.handovers = 0
+
+    def prepare(self, tm, c):
+        tm.regops.prepare(tm, c)
+        if self.compiled is not c:
+            self.compiled = c
+            self.cycles = {}
+            self.interned = {}
+            self.names = {}
+            # the states inside a register operation and those it returns in
+            self.inside = [False] * len(c.state_names)
+            self.returns = [False] * len(c.state_names)
+            for op in tm.regops.entry:
+                if op is not None:
+                    for state in op[2]:
+                        self.inside[state] = True
+                    for state in op[3:]:
+                        if state is not None:
+                            self.returns[state] = True
+            for name in c.state_names:
+                match = re.fullmatch(r"3\.(.+)\.inc", name)
+                if match and tm.regops.one is not None:
+                    transition = c.table[c.state_ids[name] * c.nsym + tm.regops.one]
+                    target = transition and re.fullmatch(r"2b\.reg\.(\d+)\.inc", c.state_names[transition[2]])
+                    if target:
+                        self.names[int(target.group(1))] = match.group(1)
+
+    def intern(self, left):
+        return self.interned.setdefault(left, left)
+
+    def entry_left(self, ops, left, lo, head):
+        """Whether the cells of left are those of an operation entered at
+        head: 00 at head - 1, head, then the -1 register up to the end"""
+        i = head - lo
+        return i >= 1 and left[i - 1] == ops.zero and left[i] == ops.zero and \
+            len(left) - i >= 3 and left.count(ops.one, i + 1) == len(left) - i - 2 and left[-1] == ops.zero
+
+    def decode(self, tm, state):
+        """Returns the RegisterFile of tm, which has just entered operation
+        entry state id state, or None if the tape is not in that form"""
+        ops = tm.regops
+        tape = tm.tape
+        cells = tape.cells
+        zero = bytes([ops.zero])
+        minus_one = cells.find(zero, tape.pos + 1)
+        if minus_one == -1:
+            return None
+        start = minus_one + 1
+        ones = []
+        i = start
+        while i < len(cells) and cells[i] != ops.zero:
+            end = cells.find(zero, i)
+            if end == -1:
+                end = len(cells)
+            if cells.count(ops.one, i, end) != end - i:
+                return None
+            ones.append(end - i)
+            i = end + 1
+        if cells.count(zero, i) != max(len(cells) - i, 0):
+            return None
+        lo = len(cells) - len(cells.lstrip(zero)) # the leftmost cell that is not blank
+        lo = min(lo, tape.pos - 1)
+        left = self.intern(bytes(cells[lo:start]))
+        rf = RegisterFile(lo - tape.origin, left, tape.head, state, ones)
+        if not self.entry_left(ops, left, rf.lo, rf.head):
+            return None
+        return rf
+
+    def encode(self, tm, rf, head):
+        """Writes the tape of rf to tm with the head at absolute cell head"""
+        one = bytes([tm.regops.one])
+        zero = bytes([tm.regops.zero])
+        cells = bytearray(rf.left)
+        for n in rf.ones:
+            cells += one * n + zero
+        tm.tape.load(rf.lo, cells, head)
+
+    def operation(self, rf, op):
+        """Returns (steps, final state) of the register operation op of
+        rf.state, or None for a register past the end of the file, see
+        operation_steps()"""
+
+        kind, k, states, break_0, break_1 = op
+        done = operation_steps(kind, k, rf.ones, rf.cells, rf.start - rf.head)
+        if done is None:
+            return None
+        steps, failed = done
+        return steps, break_1 if failed else break_0
+
+    def update(self, rf, op):
+        """Applies the register operation op to rf.ones"""
+        kind, k = op[:2]
+        ones = rf.ones
+        if k == len(ones):
+            # a register past the end is added holding 0, by inc as well
+            ones.append(1)
+            rf.cells += 2
+        elif kind == "inc":
+            ones[k] += 1
+            rf.cells += 1
+        elif ones[k] > 1:
+            # the register loses a one and the file gains a register holding 0
+            ones[k] -= 1
+            ones.append(1)
+            rf.cells += 1
+
+    def cycle(self, tm, c, lo, left, head, state):
+        """Runs the cells left of the register file from the return of an
+        operation (head in final state state) to the entry of the next
+        operation. Returns (lo, left, head, entry state, steps, states
+        entered), or None if the machine halts, reaches the register file or
+        takes more than 1 << 24 steps first."""
+
+        ops = tm.regops
+        entry = ops.entry
+        sweep = ops.sweep
+        table = c.table
+        nsym = c.nsym
+        tape = type(tm.tape)(ops.zero) # a tm.Tape
+        tape.load(lo, left, head)
+        end = lo + len(left) # the register file, not to be reached
+        entered = set()
+        steps = 0
+        while steps < 1 << 24:
+            cells = tape.cells
+            pos = tape.pos
+            index = state * nsym + cells[pos]
+            transition = table[index]
+            if transition is None:
+                return None
+            write, move, nextstate = transition
+            count = 1
+            if sweep[index]:
+                count = ops.run_length(cells, pos, cells[pos], move)
+                if move > 0:
+                    cells[pos:pos + count] = bytes([write]) * count
+                else:
+                    cells[pos - count + 1:pos + 1] = bytes([write]) * count
+            else:
+                cells[pos] = write
+            tape.pos = pos + move * count
+            if not 0 <= tape.pos < len(cells):
+                tape.extend(tape.pos)
+            steps += count
+            entered.add(nextstate)
+            state = nextstate
+            if tape.head >= end:
+                return None
+            if entry[state] is not None:
+                cells = tape.cells
+                first = min(len(cells) - len(cells.lstrip(bytes([ops.zero]))), tape.pos - 1)
+                lo = first - tape.origin
+                left = self.intern(bytes(cells[first:end + tape.origin]))
+                if len(left) != end - lo or not self.entry_left(ops, left, lo, tape.head):
+                    return None
+                return lo, left, tape.head, state, steps, frozenset(entered)
+        return None
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop: the regops loop up to a register operation, then
+        the register level while the run allows it"""
+
+        self.prepare(tm, c)
+        ops = tm.regops
+        entry = ops.entry
+        # a run can start on the entry of an operation, e.g. where the last
+        # one ended at the register level
+        rf = None if entry[state] is None else self.decode(tm, state)
+        steps = 0
+        if rf is None and self.inside[state]:
+            # finish the operation the run starts in first, where the
+            # entries of the next ones are told apart from its own states
+            stop_return = [s or r for s, r in zip(stop, self.returns)]
+            state, steps, halted = ops.run(tm, c, state, limit, stop_return, enter_only)
+            if halted or steps == limit or stop[state]:
+                return state, steps, halted
+        if rf is None:
+            # stop at the first operation entered
+            stop_entry = [s or e is not None for s, e in zip(stop, entry)]
+            state, more, halted = ops.run(tm, c, state, -1 if limit == -1 else limit - steps, stop_entry, enter_only)
+            steps += more
+            if halted or steps == limit or stop[state] or entry[state] is None:
+                return state, steps, halted
+            rf = self.decode(tm, state)
+            if rf is None:
+                return self.handover(tm, c, state, steps, limit, stop, enter_only)
+        self.last = rf
+        if self.profile is not None:
+            self.profile.start(tm.stepcount + steps)
+
+        while True:
+            left = -1 if limit == -1 else limit - steps
+            op = entry[rf.state]
+            if any(stop[s] for s in op[2]):
+                break
+            done = self.operation(rf, op)
+            if done is None:
+                break
+            cost, final = done
+            key = (rf.lo, rf.left, rf.head, final)
+            if key not in self.cycles:
+                self.cycles[key] = self.cycle(tm, c, rf.lo, rf.left, rf.head - 2, final)
+            after = self.cycles[key]
+            if self.profile is not None and after is not None:
+                # also an operation the run ends in, which the next run
+                # finishes at the TM level
+                self.profile.operation(rf, op, cost, final, after)
+            if left != -1 and cost > left:
+                break
+            if stop[final] or after is None or any(stop[s] for s in after[5]) or \
+                    (left != -1 and cost + after[4] > left):
+                # finish at the TM level from the return of the operation
+                self.update(rf, op)
+                steps += cost
+                self.ops += 1
+                self.skipped += cost
+                self.encode(tm, rf, rf.head - 2)
+                if stop[final] or steps == limit:
+                    return final, steps, False
+                return self.handover(tm, c, final, steps, limit, stop, enter_only)
+            self.update(rf, op)
+            rf.lo, rf.left, rf.head, rf.state = after[:4]
+            steps += cost + after[4]
+            self.ops += 1
+            self.skipped += cost + after[4]
+
+        self.encode(tm, rf, rf.head)
+        return self.handover(tm, c, rf.state, steps, limit, stop, enter_only)
+
+    def handover(self, tm, c, state, steps, limit, stop, enter_only):
+        """Continues the run in the regops loop"""
+        self.handovers += 1
+        if steps == limit:
+            return state, steps, False
+        state, more, halted = tm.regops.run(tm, c, state, -1 if limit == -1 else limit - steps, stop, enter_only)
+        return state, steps + more, halted
+
+    def registers(self):
+        """Returns [(name, value)] of the last decoded register file, the
+        names for the registers of the machine and "#<k>" for the others"""
+        if self.last is None:
+            return []
+        return [(self.names.get(k, "#{}".format(k)), value) for k, value in enumerate(self.last.values())]
+
+    def pc(self):
+        """The PC of the last decoded register file, as a string of its cells"""
+        if self.last is None:
+            return ""
+        rf = self.last
+        return "".join(self.compiled.symbol_names[code] for code in rf.left[:rf.head - 1 - rf.lo]).lstrip("0")
+
+    def stats(self):
+        lines = ["register machine: {} operations, {} steps skipped, {} cycles cached, {} handovers".format(
+            self.ops, self.skipped, len(self.cycles), self.handovers)]
+        if self.last is not None:
+            pc = self.pc()
+            lines.append("PC: {}{} ({} cells)".format("..." if len(pc) > 64 else "", pc[-64:], len(pc)))
+            registers = self.registers()
+            named = [(name, value) for name, value in registers if not name.startswith("#")]
+            others = [value for name, value in registers if name.startswith("#")]
+            lines.append("registers: {}".format(" ".join("{}={}".format(name, value) for name, value in named)))
+            if others:
+                lines.append("{} more registers, {} not 0".format(len(others), sum(1 for v in others if v)))
+        return "\n".join(lines)
@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+# Register operation fast path for machines built by TMBuilder.
+#
+# The framework in TMBuilder (section 2b) performs a register operation by
+# walking right from the end of the PC to the register, incrementing or
+# decrementing it while shifting the rest of the register file one cell
+# right or left, and walking back left to the "00" before the -1 register.
+# On entering 2b.reg.<k>.inc or 2b.reg.<k>.dec this loop applies the net
+# effect of all of that to the tape at once and counts its steps from the
+# positions of the zeros around it:
+#
+#   walk:   the head passes k + 2 zeros, the last at Z
+#   inc:    the first 0 after Z at E becomes 1 and the cells from E up to
+#           the next "00" at F - 1, F move one right; returns from F - 1
+#   dec:    the cells from Z + 2 up to the next "00" at u, u + 1 move one
+#           left and u becomes 1; returns from Z - 1, or if the register
+#           holds no value (one 1, or none past the end of the register
+#           file) it is left with one 1 and returns from Z
+#   return: the head walks left to the first "00" at x - 1, x and ends at
+#           x - 2 in 6.break.0, or 6.break.1 after a failed decnz
+#
+# The transitions of every state involved are checked against the
+# framework before a machine is given the fast path, so a machine that
+# only borrows the state names runs step by step. Transitions that stay in
+# their state and move are run across the whole run of the symbol they
+# read at once. Step counts, tape and state afterwards are the same as
+# stepping, so breakpoints on any state but the ones inside a register
+# operation work as usual.
+
+import re
+
+
+class RegisterOps:
+    """The "regops" engine of TuringMachine.run()"""
+
+    def __init__(self):
+        self.compiled = None
+        self.ops = 0 # register operations applied at once
+        self.sweeps = 0 # runs crossed at once
+        self.skipped = 0 # steps not simulated one by one
+
+    def prepare(self, tm, c):
+        """Finds the register operations of CompiledMachine c"""
+        if self.compiled is c:
+            return
+        self.compiled = c
+        nsym = c.nsym
+        # sweep[index]: the transition stays in its state and moves
+        self.sweep = [t is not None and t[1] != 0 and t[2] == i // nsym for i, t in enumerate(c.table)]
+        self.others = [re.compile(b"[^" + re.escape(bytes([code])) + b"]") for code in range(nsym)]
+        self.entry = [None] * len(c.state_names)
+        self.zero = c.symbol_ids.get("0")
+        self.one = c.symbol_ids.get("1")
+        if self.zero is None or self.one is None or tm.tape.fill != self.zero:
+            return
+        for name in c.state_names:
+            match = re.fullmatch(r"2b\.reg\.(\d+)\.(inc|dec)", name)
+            if match:
+                op = self.operation(c, int(match.group(1)), match.group(2))
+                if op is not None:
+                    self.entry[c.state_ids[name]] = op
+
+    def operation(self, c, k, kind):
+        """Returns (kind, k, states, break.0, break.1) for the operation
+        entered at 2b.reg.<k>.<kind>, or None if the transitions are not
+        the framework's. states are all the states passed through."""
+
+        ids = c.state_ids
+        zero = self.zero
+        one = self.one
+
+        def t(state, symbol):
+            if state is None:
+                return None
+            return c.table[state * c.nsym + symbol]
+
+        def returns(state):
+            # scan left for 00, see 2c.reg.return_*
+            if state is None or t(state, one) != (one, -1, state):
+                return None
+            second = t(state, zero)
+            if second is None or second[:2] != (zero, -1):
+                return None
+            second = second[2]
+            if t(second, one) != (one, -1, state):
+                return None
+            last = t(second, zero)
+            if last is None or last[:2] != (zero, -1):
+                return None
+            return [state, second], last[2]
+
+        states = []
+        for j in range(k, -2, -1):
+            state = ids.get("2b.reg.{}.{}".format(j, kind))
+            if state is None or t(state, one) != (one, 1, state) or \
+                    t(state, zero) != (zero, 1, ids.get("2b.reg.{}.{}".format(j - 1, kind))):
+                return None
+            states.append(state)
+        scan = ids.get("2b.reg.-2.{}".format(kind))
+        if scan is None:
+            return None
+        states.append(scan)
+
+        if kind == "inc":
+            shift_1 = t(scan, zero)
+            if t(scan, one) != (one, 1, scan) or shift_1 is None or shift_1[:2] != (one, 1):
+                return None
+            shift_1 = shift_1[2]
+            shift_2 = t(shift_1, one)
+            back = t(shift_1, zero)
+            if shift_2 is None or shift_2[:2] != (zero, 1) or back is None or back[:2] != (zero, -1):
+                return None
+            shift_2 = shift_2[2]
+            if t(shift_2, one) != (one, 1, shift_2) or t(shift_2, zero) != (one, 1, shift_1):
+                return None
+            scanned = returns(back[2])
+            if scanned is None:
+                return None
+            states += [shift_1, shift_2] + scanned[0]
+            return (kind, k, set(states), scanned[1], None)
+
+        # dec, see 2b.reg.-2.dec and 2b.reg.dec.*
+        failed = t(scan, zero)
+        check = t(scan, one)
+        if failed is None or failed[:2] != (one, -1) or check is None or check[:2] != (zero, 1):
+            return None
+        check = check[2]
+        scan_1 = t(check, one)
+        if t(check, zero) != (zero, -1, scan) or scan_1 is None or scan_1[:2] != (one, 1):
+            return None
+        scan_1 = scan_1[2]
+        scan_2 = t(scan_1, zero)
+        if t(scan_1, one) != (one, 1, scan_1) or scan_2 is None or scan_2[:2] != (zero, 1):
+            return None
+        scan_2 = scan_2[2]
+        shift_1 = t(scan_2, zero)
+        if t(scan_2, one) != (one, 1, scan_1) or shift_1 is None or shift_1[:2] != (zero, -1):
+            return None
+        shift_1 = shift_1[2]
+        shift_2 = t(shift_1, zero)
+        if t(shift_1, one) != (one, -1, shift_1) or shift_2 is None or shift_2[:2] != (one, -1):
+            return None
+        shift_2 = shift_2[2]
+        back = t(shift_2, zero)
+        if t(shift_2, one) != (zero, -1, shift_1) or back is None or back[:2] != (zero, -1):
+            return None
+        scanned = returns(back[2])
+        scanned_failed = returns(failed[2])
+        if scanned is None or scanned_failed is None:
+            return None
+        states += [check, scan_1, scan_2, shift_1, shift_2] + scanned[0] + scanned_failed[0]
+        return (kind, k, set(states), scanned[1], scanned_failed[1])
+
+    def find(self, tape, pattern, i):
+        """The first index of pattern in tape.cells from i, growing the
+        buffer on the right (where cells hold fill) until it is found"""
+        while True:
+            j = tape.cells.find(pattern, i)
+            if j != -1:
+                return j
+            end = len(tape.cells) - tape.origin
+            tape.ensure(end, end + 1)
+
+    def apply(self, tape, op, left):
+        """Applies register operation op entered with the head at tape.pos,
+        if it takes at most left steps (any number if left is -1). Returns
+        (steps, final state) or None."""
+
+        kind, k, states, break_0, break_1 = op
+        zero = self.zero
+        one = self.one
+        pair = bytes([zero, zero])
+        # the return needs fill cells at the left end of the buffer
+        if tape.cells[:2] != pair:
+            tape.ensure(-tape.origin - 2, -tape.origin)
+        h = tape.pos
+        z = h - 1
+        for _ in range(k + 2):
+            z = self.find(tape, bytes([zero]), z + 1)
+        cells = tape.cells
+        steps = z + 1 - h
+
+        if kind == "inc":
+            e = self.find(tape, bytes([zero]), z + 1)
+            f = self.find(tape, pair, e) + 1
+            cells = tape.cells
+            steps += f - z
+            start = f - 1
+            final = break_0
+        else:
+            a = z + 1
+            if cells[a] == zero:
+                steps += 1
+                start = z
+                final = break_1
+            elif cells[a + 1] == zero:
+                steps += 3
+                start = z
+                final = break_1
+            else:
+                u = self.find(tape, pair, a + 2)
+                cells = tape.cells
+                steps += u - a + u - z + 3
+                start = z - 1
+                final = break_0
+        # the cells left of the ones changed are as they were
+        x = cells.rfind(pair, 0, min(start, z) + 1) + 1
+        steps += start - x + 2
+        if left != -1 and steps > left:
+            return None
+
+        if kind == "inc":
+            cells[e + 1:f] = cells[e:f - 1]
+            cells[e] = one
+        elif final == break_1:
+            cells[z + 1] = one
+        else:
+            cells[a:u] = cells[a + 1:u + 1]
+            cells[u] = one
+        tape.pos = x - 2
+        self.ops += 1
+        self.skipped += steps
+        return steps, final
+
+    def run_length(self, cells, pos, code, move):
+        """The number of cells holding code from pos on in the direction of move"""
+        if move > 0:
+            other = self.others[code].search(cells, pos)
+            return (other.start() if other else len(cells)) - pos
+        window = 64
+        while True:
+            lo = max(pos + 1 - window, 0)
+            kept = len(cells[lo:pos + 1].rstrip(bytes([code])))
+            if kept or lo == 0:
+                return pos + 1 - lo - kept
+            window *= 4
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop with the fast paths"""
+
+        self.prepare(tm, c)
+        entry = self.entry
+        sweep = self.sweep
+        table = c.table
+        nsym = c.nsym
+        tape = tm.tape
+        cells = tape.cells
+        pos = tape.pos
+        end = len(cells)
+        steps = 0
+        halted = False
+        blocked = {} # entry state -> whether a stop state is inside the operation
+
+        while steps != limit:
+            index = state * nsym + cells[pos]
+            transition = table[index]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            if sweep[index] and (enter_only or not stop[state]):
+                code = cells[pos]
+                count = self.run_length(cells, pos, code, move)
+                if limit != -1:
+                    count = min(count, limit - steps)
+                if move > 0:
+                    cells[pos:pos + count] = bytes([write]) * count
+                else:
+                    cells[pos - count + 1:pos + 1] = bytes([write]) * count
+                pos += move * count
+                steps += count
+                if count > 1:
+                    self.sweeps += 1
+                    self.skipped += count
+                if pos == end or pos < 0:
+                    pos = tape.extend(pos)
+                    cells = tape.cells
+                    end = len(cells)
+                continue
+            cells[pos] = write
+            pos += move
+            if pos == end or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+                end = len(cells)
+            steps += 1
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+            op = entry[state]
+            if op is not None:
+                if state not in blocked:
+                    blocked[state] = any(stop[s] for s in op[2])
+                if not blocked[state]:
+                    tape.pos = pos
+                    done = self.apply(tape, op, -1 if limit == -1 else limit - steps)
+                    # the buffer may have grown either way
+                    cells = tape.cells
+                    end = len(cells)
+                    pos = tape.pos
+                    if done is not None:
+                        steps += done[0]
+                        nextstate = done[1]
+                        if pos == end or pos < 0:
+                            pos = tape.extend(pos)
+                            cells = tape.cells
+                            end = len(cells)
+                        if stop[nextstate]:
+                            state = nextstate
+                            break
+                        state = nextstate
+
+        tape.pos = pos
+        return state, steps, halted
+
+    def stats(self):
+        return "register ops: {} operations and {} runs crossed at once, {} steps skipped".format(
+            self.ops, self.sweeps, self.skipped)
@@ -0,0 +1,473 @@
+#!/usr/bin/python3
+
+# Inductive rule engine for tm.TuringMachine on an RLETape, in the style of
+# the Busy Beaver "proof system" simulators.
+#
+# Before each sweep across a run the engine takes a checkpoint: the state,
+# the symbol under the head, the symbols of the nearest `window` runs on
+# each side and the lengths of those runs shorter than `threshold`. When a
+# checkpoint repeats with some of the longer runs changed, the engine
+# replays the machine from the current configuration with the long run
+# lengths replaced by variables (runs the machine reads to their end keep
+# their current length). If the replay comes back to the same
+# checkpoint with every variable x changed to x + delta and every other run
+# length unchanged, the rule is proven for all run lengths that satisfy the
+# conditions met along the way. It can then be applied k times in one jump;
+# the step count and head movement of each application are linear in the
+# variables, so the total over k applications has a closed form.
+
+from collections import namedtuple
+
+
+class Lin:
+    """const + sum(coeffs[v] * x_v) for the run length variables x_v"""
+
+    __slots__ = ("const", "coeffs")
+
+    def __init__(self, const=0, coeffs=None):
+        self.const = const
+        self.coeffs = coeffs or {}
+
+    def __add__(self, other):
+        if isinstance(other, int):
+            return Lin(self.const + other, self.coeffs)
+        coeffs = dict(self.coeffs)
+        for v, coeff in other.coeffs.items():
+            coeffs[v] = coeffs.get(v, 0) + coeff
+        return Lin(self.const + other.const, coeffs)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __neg__(self):
+        return Lin(-self.const, {v: -coeff for v, coeff in self.coeffs.items()})
+
+    def __mul__(self, k):
+        return Lin(self.const * k, {v: coeff * k for v, coeff in self.coeffs.items()})
+
+    __rmul__ = __mul__
+
+    def __eq__(self, other):
+        if isinstance(other, int):
+            other = Lin(other)
+        return self.const == other.const and \
+            {v: c for v, c in self.coeffs.items() if c} == {v: c for v, c in other.coeffs.items() if c}
+
+    def is_const(self):
+        return not any(self.coeffs.values())
+
+    def value(self, xs):
+        return self.const + sum(coeff * xs[v] for v, coeff in self.coeffs.items())
+
+    def __repr__(self):
+        terms = ["{}*x{}".format(coeff, v) if coeff != 1 else "x{}".format(v)
+                 for v, coeff in sorted(self.coeffs.items()) if coeff]
+        if self.const or not terms:
+            terms.append(str(self.const))
+        return " + ".join(terms)
+
+
+# variables, fixed and deltas are keyed by index into the run lengths of a
+# checkpoint: the left window runs outermost first, then the right window
+# runs outermost first. requirements are (Lin, minimum) pairs that must hold
+# before every application. steps and shift are the steps taken and head
+# movement of one application.
+Rule = namedtuple("Rule", ["number", "key", "variables", "fixed", "deltas", "requirements",
+                           "steps", "shift", "visited"])
+
+
+class ProofFailed(Exception):
+    pass
+
+
+class RunOut(ProofFailed):
+    """A run of variable length was read to its end"""
+
+    def __init__(self, variable):
+        super().__init__("a run of variable length runs out")
+        self.variable = variable
+
+
+class RuleEngine:
+    """Finds, proves and applies inductive rules while running an RLETape"""
+
+    def __init__(self, window=16, threshold=4, proof_steps=100000, max_backoff=1023,
+                 history_size=10000000, verbose=False):
+        self.window = window
+        self.threshold = threshold
+        self.proof_steps = proof_steps
+        self.history_size = history_size
+        self.max_backoff = max_backoff
+        self.verbose = verbose
+        self.compiled = None
+        self.clear()
+
+    def clear(self, slots=0):
+        # checkpoints at a (state, symbol) slot that keep finding no rule are
+        # taken exponentially less often
+        self.skip = [0] * slots
+        self.backoff = [0] * slots
+        self.rules = {}
+        self.history = {}
+        self.history_cells = 0 # run lengths kept in history
+        self.proof_work = 0 # engine steps spent replaying
+        self.failures = {}
+        self.fired = {} # rule number -> [applications, steps]
+        self.rule_count = 0
+
+    def checkpoint_key(self, state, cur, left, right, left_complete, right_complete):
+        """The checkpoint key for stacks that may have more runs beyond them"""
+        w = self.window
+        return (state, cur,
+                tuple(run[0] for run in left[-w:]), left_complete and len(left) <= w,
+                tuple(run[0] for run in right[-w:]), right_complete and len(right) <= w)
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop for the rules engine, returns (state, steps, halted).
+
+        Like TuringMachine.run_rle() with a checkpoint before each sweep."""
+
+        if self.compiled is not c:
+            self.clear(len(c.table))
+            self.compiled = c
+        table = c.table
+        skip = self.skip
+        backoff = self.backoff
+        max_backoff = self.max_backoff
+        nsym = c.nsym
+        tape = tm.tape
+        left = tape.left
+        right = tape.right
+        cur = tape.cur
+        head = tape.head
+        fill = self.fill = tape.fill
+        w = self.window
+        stopset = frozenset(i for i, s in enumerate(stop) if s)
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            transition = table[state * nsym + cur]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            count = 1
+            if move == 0:
+                cur = write
+            else:
+                if move > 0:
+                    behind, ahead = left, right
+                else:
+                    behind, ahead = right, left
+                if nextstate == state and not (stop[state] and not enter_only):
+                    if ahead and ahead[-1][0] == cur:
+                        slot = state * nsym + cur
+                        if skip[slot]:
+                            skip[slot] -= 1
+                            jump = None
+                        else:
+                            key = (state, cur,
+                                   tuple(run[0] for run in left[-w:]), len(left) <= w,
+                                   tuple(run[0] for run in right[-w:]), len(right) <= w)
+                            counts = tuple(run[1] for run in left[-w:]) + tuple(run[1] for run in right[-w:])
+                            jump = self.checkpoint(c, key, counts, left, right, stopset,
+                                                   -1 if limit == -1 else limit - steps,
+                                                   tm.stepcount + steps)
+                            if jump is False:
+                                backoff[slot] = min(backoff[slot] * 2 + 1, max_backoff)
+                                skip[slot] = backoff[slot]
+                            else:
+                                backoff[slot] = 0
+                        if jump:
+                            if jump[0] is None:
+                                tm.looping = True
+                                break
+                            steps += jump[0]
+                            head += jump[1]
+                            continue
+                        run = ahead[-1]
+                        count = run[1] + 1
+                        if limit != -1 and count > limit - steps:
+                            count = limit - steps
+                        if count - 1 == run[1]:
+                            ahead.pop()
+                        else:
+                            run[1] -= count - 1
+                    elif not ahead and cur == fill:
+                        # sweeping out into blank tape
+                        if limit == -1:
+                            tm.looping = True
+                            break
+                        count = limit - steps
+                if behind and behind[-1][0] == write:
+                    behind[-1][1] += count
+                else:
+                    behind.append([write, count])
+                if ahead:
+                    run = ahead[-1]
+                    cur = run[0]
+                    if run[1] == 1:
+                        ahead.pop()
+                    else:
+                        run[1] -= 1
+                else:
+                    cur = fill
+                head += move * count
+            steps += count
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+        tape.cur = cur
+        tape.head = head
+        tape.trim()
+        return state, steps, halted
+
+    def checkpoint(self, c, key, counts, left, right, stopset, remaining, stepcount):
+        """Applies a rule at a checkpoint if one is known, or tries to prove one.
+
+        Returns False if there is no rule for the checkpoint, None if the
+        rule could not be applied, (steps, head movement) if it was, or
+        (None, None) if it applies forever."""
+
+        # runs shorter than the threshold are part of the checkpoint, longer
+        # runs are the variables of a rule
+        small = tuple(n if n < self.threshold else 0 for n in counts)
+        for rule in self.rules.get((key, small), ()):
+            if all(counts[i] == n for i, n in rule.fixed.items()):
+                break
+        else:
+            previous = self.history.get((key, small))
+            if self.history_cells > self.history_size:
+                self.history.clear()
+                self.history_cells = 0
+            self.history[(key, small)] = (counts, stepcount)
+            self.history_cells += len(counts)
+            if previous is None or previous[0] == counts or self.failures.get((key, small), 0) >= 3:
+                return False
+            if self.proof_work > stepcount // 8 + self.proof_steps:
+                # proofs that keep failing should not slow the machine down
+                return False
+            variables = frozenset(i for i, n in enumerate(small) if not n)
+            # the replay should come back in about as many steps as it took
+            # the machine to get here from the previous checkpoint
+            max_steps = 2 * (stepcount - previous[1]) + 100
+            try:
+                rule = self.prove(c, key, counts, variables, max_steps)
+            except ProofFailed as e:
+                self.failures[(key, small)] = self.failures.get((key, small), 0) + 1
+                if self.verbose:
+                    print("no rule at {}: {}".format(c.state_names[key[0]], e))
+                return False
+            self.rules.setdefault((key, small), []).append(rule)
+            if self.verbose:
+                print("proved rule {} at {}: {}".format(rule.number, c.state_names[key[0]], self.describe(rule)))
+        return self.apply(c, rule, counts, left, right, stopset, remaining)
+
+    def prove(self, c, key, counts, variables, max_steps):
+        """Returns the Rule proven by replaying from a checkpoint, fixing
+        the runs the machine reads to the end (like the bits of a PC) to
+        their current lengths until the replay succeeds."""
+
+        while True:
+            try:
+                return self.replay(c, key, counts, variables, max_steps)
+            except RunOut as e:
+                if e.variable is None:
+                    raise
+                variables = variables - {e.variable}
+
+    def replay(self, c, key, counts, variables, max_steps):
+        """Replays the machine with symbolic run lengths from a checkpoint
+        back to the same checkpoint and returns the Rule it proves."""
+
+        state, cur, left_codes, left_complete, right_codes, right_complete = key
+        table = c.table
+        nsym = c.nsym
+        fill = self.fill
+        # run lengths stay ints unless they depend on a variable
+        left = [[code, count] for code, count in zip(left_codes, counts)]
+        right = [[code, count] for code, count in zip(right_codes, counts[len(left_codes):])]
+        for v in variables:
+            stack, i = (left, v) if v < len(left_codes) else (right, v - len(left_codes))
+            stack[i][1] = Lin(0, {v: 1})
+        xs = {v: counts[v] for v in variables}
+        requirements = []
+        visited = set()
+        # steps and head movement so far, split into ints and the part that
+        # depends on the variables
+        steps = shift = 0
+        var_steps = var_shift = Lin()
+        start = key
+        complete = (left_complete, right_complete)
+
+        engine_step = 0
+        try:
+            for engine_step in range(min(max_steps, self.proof_steps)):
+                transition = table[state * nsym + cur]
+                if transition is None:
+                    raise ProofFailed("halts")
+                write, move, nextstate = transition
+                visited.add(nextstate)
+                count = 1
+                if move == 0:
+                    cur = write
+                else:
+                    if move > 0:
+                        behind, ahead, ahead_complete, behind_complete = left, right, complete[1], complete[0]
+                    else:
+                        behind, ahead, ahead_complete, behind_complete = right, left, complete[0], complete[1]
+                    if nextstate == state and ahead and ahead[-1][0] == cur:
+                        if engine_step > 0 and state == start[0] and cur == start[1] and \
+                                self.checkpoint_key(state, cur, left, right, *complete) == start:
+                            rule = self.make_rule(start, counts, variables, left, right, requirements,
+                                                  var_steps + steps, var_shift + shift, visited)
+                            if rule is not None:
+                                return rule
+                            if steps + var_steps.value(xs) > max_steps:
+                                break
+                        count = ahead.pop()[1] + 1
+                    elif nextstate == state and not ahead and cur == fill and ahead_complete:
+                        raise ProofFailed("sweeps into blank tape")
+                    if behind and behind[-1][0] == write:
+                        behind[-1][1] = behind[-1][1] + count
+                    elif behind or behind_complete:
+                        behind.append([write, count])
+                    else:
+                        raise ProofFailed("writes beyond the window")
+                    if ahead:
+                        run = ahead[-1]
+                        cur = run[0]
+                        if type(run[1]) is int:
+                            if run[1] == 1:
+                                ahead.pop()
+                            else:
+                                run[1] -= 1
+                        elif run[1].value(xs) < 2:
+                            terms = [v for v, coeff in run[1].coeffs.items() if coeff]
+                            raise RunOut(terms[0] if len(terms) == 1 else None)
+                        else:
+                            requirements.append((run[1], 2))
+                            run[1] = run[1] + -1
+                    elif ahead_complete:
+                        cur = fill
+                    else:
+                        raise ProofFailed("reads beyond the window")
+                    if type(count) is int:
+                        shift += count * move
+                    else:
+                        var_shift = var_shift + count * move
+                if type(count) is int:
+                    steps += count
+                else:
+                    var_steps = var_steps + count
+                state = nextstate
+        finally:
+            self.proof_work += engine_step
+        raise ProofFailed("no repeat within {} steps".format(max_steps))
+
+    def make_rule(self, key, counts, variables, left, right, requirements, steps, shift, visited):
+        """The Rule for a replay that is back at its checkpoint, or None if
+        the run lengths have not changed by constants"""
+        ends = [run[1] for run in left] + [run[1] for run in right]
+        if len(ends) != len(counts):
+            return None
+        deltas = {}
+        fixed = {}
+        for i, end in enumerate(ends):
+            if i in variables:
+                delta = -Lin(0, {i: 1}) + end
+                if not delta.is_const():
+                    return None
+                deltas[i] = delta.const
+            else:
+                if type(end) is not int or end != counts[i]:
+                    return None
+                fixed[i] = counts[i]
+        self.rule_count += 1
+        return Rule(self.rule_count, key, variables, fixed, deltas, list(requirements),
+                    steps, shift, frozenset(visited))
+
+    def apply(self, c, rule, counts, left, right, stopset, remaining):
+        for i, count in rule.fixed.items():
+            if counts[i] != count:
+                return None
+        if not stopset.isdisjoint(rule.visited):
+            return None
+
+        xs = {v: counts[v] for v in rule.variables}
+        # every run keeps at least one cell after the last application
+        times = None
+        for v, delta in rule.deltas.items():
+            if delta < 0:
+                limit = (xs[v] - 1) // -delta
+                times = limit if times is None else min(times, limit)
+        for expr, minimum in rule.requirements:
+            a = expr.value(xs)
+            b = sum(coeff * rule.deltas[v] for v, coeff in expr.coeffs.items())
+            if a < minimum:
+                return None
+            if b < 0:
+                limit = (a - minimum) // -b + 1
+                times = limit if times is None else min(times, limit)
+
+        if times is None:
+            if remaining == -1:
+                if self.verbose:
+                    print("rule {} applies forever".format(rule.number))
+                return (None, None)
+            times = 1
+            while self.total(rule.steps, rule, xs, times * 2) <= remaining:
+                times *= 2
+        if remaining != -1:
+            # largest number of applications that fits in the remaining steps
+            lo, hi = 0, times
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.total(rule.steps, rule, xs, mid) <= remaining:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            times = lo
+        if times < 1:
+            return None
+
+        steps = self.total(rule.steps, rule, xs, times)
+        shift = self.total(rule.shift, rule, xs, times)
+        w = len(rule.key[2])
+        for v, delta in rule.deltas.items():
+            if v < w:
+                left[len(left) - w + v][1] += delta * times
+            else:
+                right[len(right) - len(rule.key[4]) + v - w][1] += delta * times
+        fired = self.fired.setdefault(rule.number, [0, 0])
+        fired[0] += times
+        fired[1] += steps
+        if self.verbose:
+            print("rule {} x {}: {} steps".format(rule.number, times, steps))
+        return (steps, shift)
+
+    @staticmethod
+    def total(expr, rule, xs, times):
+        """sum of expr over times applications starting from xs"""
+        per_application = sum(coeff * rule.deltas[v] for v, coeff in expr.coeffs.items())
+        return expr.value(xs) * times + per_application * times * (times - 1) // 2
+
+    def describe(self, rule):
+        names = {v: "x{}".format(v) for v in rule.variables}
+        changes = ", ".join("{} {:+}".format(names[v], d) for v, d in sorted(rule.deltas.items()))
+        return "{} ({} steps)".format(changes or "no change", rule.steps)
+
+    def stats(self):
+        lines = []
+        rules = sorted((rule for rules in self.rules.values() for rule in rules), key=lambda r: r.number)
+        for rule in rules:
+            applications, steps = self.fired.get(rule.number, (0, 0))
+            lines.append("rule {}: {}, applied {} times for {} steps".format(
+                rule.number, self.describe(rule), applications, steps))
+        lines.append("{} rules, {} checkpoints without a rule".format(len(rules), len(self.failures)))
+        return "\n".join(lines)
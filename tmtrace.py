@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+
+# Execution traces of tm.TuringMachine runs, recorded to disk and read back
+# without running the machine.
+#
+# A trace file starts with MAGIC and holds records of a type byte, a 64 bit
+# length and the payload:
+#
+#   T: the compiled transition table as JSON (state names, symbol names and
+#      [write, move, next state] or null for each transition id, the index
+#      state * nsym + symbol into the table), for the blocks that follow
+#   K: a block: a keyframe header (BLOCK), the cells of the tape at the
+#      keyframe compressed with zlib, then the transition ids of the steps
+#      after it, as planes of the low bytes of the ids (all the lowest
+#      bytes, then the next ones, as many as the table needs), also
+#      compressed with zlib
+#
+# The recorder observes the steps of step() and run() in the batches of
+# tmevents, alongside any other observers. A block starts at the first batch
+# after every so many steps, and wherever the machine was changed between
+# batches (the step count, state or head are not where the last recorded
+# batch left them). Blocks are encoded and written by a background thread.
+# The encoding is done by slicing and zlib, which runs without holding the
+# interpreter lock, so the thread takes little time from the run: recording
+# costs it an append of each batch's ids, and the event stream loop in place
+# of the selected engine.
+
+import argparse
+import json
+import queue
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from tm import Tape
+
+MAGIC = b"tm-trace 2\n"
+
+RECORD = struct.Struct("<cQ")
+
+# first step, state id, head, first cell of the keyframe, fill code, length
+# of the compressed cells, steps in the block, bytes per transition id
+BLOCK = struct.Struct("<qqqqqQQB")
+
+
+def id_width(c):
+    """The bytes needed for the transition ids of CompiledMachine c"""
+    return max(((len(c.table) - 1).bit_length() + 7) // 8, 1)
+
+
+def encode_ids(ids, width):
+    """The low width bytes of the ids in array('q') ids, as planes"""
+    if sys.byteorder == "big":
+        ids = array('q', ids)
+        ids.byteswap()
+    data = ids.tobytes()
+    return b"".join(data[k::8] for k in range(width))
+
+
+def decode_ids(data, width):
+    n = len(data) // width
+    out = bytearray(8 * n)
+    for k in range(width):
+        out[k::8] = data[k * n:(k + 1) * n]
+    ids = array('q')
+    ids.frombytes(out)
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids
+
+
+class TraceRecorder:
+    """Records the steps of a TuringMachine while it is tm.recorder, as an
+    observer of its tmevents.EventStream"""
+
+    def __init__(self, filename, every=1 << 16):
+        self.filename = filename
+        self.every = every
+        self.file = open(filename, "wb")
+        self.file.write(MAGIC)
+        self.queue = queue.Queue(maxsize=16)
+        self.writer = threading.Thread(target=self.write_records, daemon=True)
+        self.writer.start()
+        self.compiled = None # CompiledMachine of the current block
+        self.keyframe = None # (step, state, head, lo, fill, cells) of the current block
+        self.ids = array('q')
+        self.next = None # (step, state, head) where the last recorded batch stopped
+        self.steps = 0
+        self.blocks = 0
+
+    def write_records(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, payload = item
+            if kind == b"K":
+                (step, state, head, lo, fill, cells), ids, width = payload
+                cells = zlib.compress(cells, 1)
+                payload = BLOCK.pack(step, state, head, lo, fill, len(cells), len(ids), width) + cells + \
+                    zlib.compress(encode_ids(ids, width))
+            self.file.write(RECORD.pack(kind, len(payload)))
+            self.file.write(payload)
+
+    def flush(self):
+        """Hands the current block to the writer thread"""
+        if self.keyframe is not None and self.ids:
+            self.queue.put((b"K", (self.keyframe, self.ids, id_width(self.compiled))))
+            self.blocks += 1
+        self.keyframe = None
+        self.ids = array('q')
+
+    def keyframe_at(self, tm, c, state, step):
+        """Starts a block at the current configuration"""
+        self.flush()
+        if self.compiled is not c:
+            table = {
+                "states": c.state_names,
+                "symbols": c.symbol_names,
+                "nsym": c.nsym,
+                "table": c.table,
+            }
+            self.queue.put((b"T", json.dumps(table).encode()))
+            self.compiled = c
+        bounds = tm.tape.bounds()
+        head = tm.tape.head
+        lo, hi = (head, head) if bounds is None else (min(bounds[0], head), max(bounds[1], head))
+        self.keyframe = (step, state, head, lo, tm.tape.fill, tm.tape.get_range(lo, hi + 1))
+
+    def begin(self, tm, c, state, step):
+        """Called where a batch starts, see tmevents.EventStream"""
+        if self.compiled is not c or self.keyframe is None or len(self.ids) >= self.every or \
+                self.next != (step, state, tm.tape.head):
+            self.keyframe_at(tm, c, state, step)
+
+    def __call__(self, batch):
+        """Appends the transition ids of a tmevents.EventBatch to the block"""
+        ids = batch.ids
+        self.ids.extend(ids)
+        self.steps += len(ids)
+        write, move, nextstate = batch.compiled.table[ids[-1]]
+        self.next = (batch.first + len(ids), nextstate, batch.heads[-1] + move)
+
+    def close(self):
+        """Writes the last block and waits for the writer"""
+        self.flush()
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
+
+    def stats(self):
+        return "recording to {}: {} steps, {} blocks written".format(self.filename, self.steps, self.blocks)
+
+
+class TraceReader:
+    """Reads a trace file: the block index is built on opening, the blocks
+    are decoded when needed"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tables = []
+        self.blocks = [] # (first step, steps, table, offset and length of the payload)
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a trace".format(filename))
+            while True:
+                record = f.read(RECORD.size)
+                if len(record) < RECORD.size:
+                    break
+                kind, length = RECORD.unpack(record)
+                offset = f.tell()
+                if kind == b"T":
+                    self.tables.append(json.loads(f.read(length)))
+                else:
+                    step, state, head, lo, fill, cells_length, steps, width = BLOCK.unpack(f.read(BLOCK.size))
+                    self.blocks.append((step, steps, len(self.tables) - 1, offset, length))
+                    f.seek(offset + length)
+
+    def block(self, i):
+        """Returns (keyframe tape, state, ids, table) of block i"""
+        step, steps, table, offset, length = self.blocks[i]
+        with open(self.filename, "rb") as f:
+            f.seek(offset)
+            payload = f.read(length)
+        step, state, head, lo, fill, cells_length, steps, width = BLOCK.unpack_from(payload)
+        start = BLOCK.size
+        cells = zlib.decompress(payload[start:start + cells_length])
+        ids = decode_ids(zlib.decompress(payload[start + cells_length:]), width)
+        tape = Tape(fill)
+        tape.load(lo, cells, head)
+        return tape, state, ids, self.tables[table]
+
+    def transitions(self):
+        """Yields (step, state, symbol, next state) for every recorded step,
+        step being the step count after it"""
+        for i, (first, steps, table, offset, length) in enumerate(self.blocks):
+            table = self.tables[table]
+            names = table["states"]
+            symbols = table["symbols"]
+            nsym = table["nsym"]
+            entries = table["table"]
+            for n, index in enumerate(self.block(i)[2], first + 1):
+                yield n, names[index // nsym], symbols[index % nsym], names[entries[index][2]]
+
+    def configuration(self, n):
+        """Returns (state, head, lo, cells) at step count n, replaying the
+        recorded transitions from the nearest keyframe before it. cells are
+        symbol names from absolute cell lo. Steps recorded more than once,
+        e.g. after reverse-step, are taken from the latest recording."""
+        for i in range(len(self.blocks) - 1, -1, -1):
+            first, steps, table, offset, length = self.blocks[i]
+            if first <= n <= first + steps:
+                break
+        else:
+            raise ValueError("step {} was not recorded".format(n))
+        tape, state, ids, table = self.block(i)
+        entries = table["table"]
+        cells = tape.cells
+        pos = tape.pos
+        for index in ids[:n - first]:
+            write, move, state = entries[index]
+            cells[pos] = write
+            pos += move
+            if pos == len(cells) or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+        tape.pos = pos
+        lo, hi = tape.bounds() or (tape.head, tape.head)
+        lo, hi = min(lo, tape.head), max(hi, tape.head)
+        symbols = table["symbols"]
+        return table["states"][state], tape.head, lo, [symbols[code] for code in tape.get_range(lo, hi + 1)]
+
+    def histogram(self):
+        """Returns {state: number of steps into it}"""
+        counts = {}
+        for n, state, symbol, nextstate in self.transitions():
+            counts[nextstate] = counts.get(nextstate, 0) + 1
+        return counts
+
+    def entered(self, name, after=0):
+        """The first step count after after at which the machine entered
+        state name from another state, or None"""
+        for n, state, symbol, nextstate in self.transitions():
+            if n > after and nextstate == name and state != name:
+                return n
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query a trace recorded by tmdb")
+    parser.add_argument("trace", help="trace file")
+    parser.add_argument("--at", type=int, metavar="N", help="show the configuration at step count N")
+    parser.add_argument("--histogram", action="store_true", help="count the steps into each state")
+    parser.add_argument("--entered", metavar="STATE", help="find the first step entering STATE")
+    parser.add_argument("--after", type=int, default=0, metavar="N", help="with --entered, only after step N")
+    args = parser.parse_args()
+
+    reader = TraceReader(args.trace)
+    if reader.blocks:
+        first = reader.blocks[0][0]
+        last = reader.blocks[-1][0] + reader.blocks[-1][1]
+        print("{} blocks, steps {} to {}".format(len(reader.blocks), first, last))
+    if args.at is not None:
+        state, head, lo, cells = reader.configuration(args.at)
+        left = "".join(cells[:head - lo])
+        right = "".join(cells[head - lo + 1:])
+        print("{} {}[{}]{}".format(state, left[-35:], cells[head - lo], right[:35]))
+    if args.histogram:
+        for state, count in sorted(reader.histogram().items(), key=lambda item: -item[1]):
+            print("{:>14} {}".format(count, state))
+    if args.entered:
+        n = reader.entered(args.entered, args.after)
+        print("not entered" if n is None else "entered {} at step {}".format(args.entered, n))
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+# Undo log for reverse execution of tm.TuringMachine runs on a byte Tape.
+#
+# Every step appends one packed entry to a ring buffer of 64 bit integers:
+# the state id before the step, the symbol code the step overwrote and the
+# move, as state << 10 | code << 2 | move + 1. Undoing a step moves the head
+# back, puts the old symbol back and restores the old state. The buffer
+# holds budget // 8 entries and overwrites the oldest entries when full.
+
+from array import array
+
+
+class UndoLog:
+    """Ring buffer of packed undo entries, with the table loop that fills it"""
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.capacity = budget // 8
+        self.entries = array('q') # allocated by the first run
+        self.clear()
+
+    def clear(self):
+        self.next = 0 # index of the next entry to write
+        self.size = 0 # entries that can be undone
+        self.compiled = None # CompiledMachine whose state ids the entries hold
+
+    def start(self, c):
+        """Prepares the log for a run of CompiledMachine c"""
+        if len(self.entries) != self.capacity:
+            self.entries = array('q', bytes(self.capacity * 8))
+        if self.compiled is not c:
+            self.clear()
+            self.compiled = c
+
+    def run(self, tm, c, state, limit, stop, enter_only):
+        """The run() loop, also appending an undo entry for every step"""
+
+        self.start(c)
+        entries = self.entries
+        capacity = self.capacity
+        i = self.next
+        table = c.table
+        nsym = c.nsym
+        tape = tm.tape
+        cells = tape.cells
+        pos = tape.pos
+        end = len(cells)
+        steps = 0
+        halted = False
+
+        while steps != limit:
+            old = cells[pos]
+            transition = table[state * nsym + old]
+            if transition is None:
+                halted = True
+                break
+            write, move, nextstate = transition
+            entries[i] = state << 10 | old << 2 | move + 1
+            i += 1
+            if i == capacity:
+                i = 0
+            cells[pos] = write
+            pos += move
+            if pos == end or pos < 0:
+                pos = tape.extend(pos)
+                cells = tape.cells
+                end = len(cells)
+            steps += 1
+            if stop[nextstate] and (nextstate != state or not enter_only):
+                state = nextstate
+                break
+            state = nextstate
+
+        tape.pos = pos
+        self.next = i
+        self.size = min(self.size + steps, capacity)
+        return state, steps, halted
+
+    def undo(self, tm, count=-1, stop_states=(), enter_only=False):
+        """Undoes up to count steps (all logged steps if -1), stopping early
+        in one of stop_states like run(): if enter_only is set, only where
+        the undone-to step was a transition from another state.
+
+        Returns the number of steps undone."""
+
+        c = tm.compile()
+        if self.compiled is not c:
+            # the transition table changed, the state ids may not match
+            self.clear()
+            return 0
+        entries = self.entries
+        capacity = self.capacity
+        i = self.next
+        stop = [name in stop_states for name in c.state_names]
+        tape = tm.tape
+        cells = tape.cells
+        pos = tape.pos
+        steps = 0
+
+        while steps != count and steps != self.size:
+            i = (i - 1) % capacity
+            entry = entries[i]
+            pos -= (entry & 3) - 1
+            if pos < 0 or pos >= len(cells):
+                pos = tape.extend(pos)
+                cells = tape.cells
+            cells[pos] = (entry >> 2) & 255
+            state = entry >> 10
+            steps += 1
+            if stop[state]:
+                if not enter_only or steps == self.size or entries[(i - 1) % capacity] >> 10 != state:
+                    break
+
+        tape.pos = pos
+        if tape.grown:
+            tape.trim()
+        self.next = i
+        self.size -= steps
+        if steps:
+            tm.statename = c.state_names[state]
+            tm.stepcount -= steps
+        return steps
+
+    def stats(self):
+        return "undo log: {} of {} steps ({} bytes)".format(self.size, self.capacity, self.budget)
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+# Lockstep simulation of many Turing machines with NumPy.
+#
+# Every lane is an independent machine: its state, head and step count are
+# entries of NumPy arrays and its tape is a row of a 2D array of symbol
+# codes. The transition tables of all lanes are merged into one integer
+# table, machines that share a transition table sharing its states, so a
+# step of every running lane is a gather from the tapes, a gather from the
+# table and a scatter back. Lanes on an undefined transition are masked out.
+
+import argparse
+import random
+import time
+import numpy as np
+from tm import TuringMachine
+
+
+class LockstepBatch:
+    """Runs TuringMachines in lockstep from their current configurations.
+    store() writes the results back into the machines."""
+
+    def __init__(self, machines, margin=256):
+        self.machines = machines
+        self.symbol_names = []
+        self.symbol_ids = {}
+        self.state_names = []
+        # merge the compiled tables, one block of states per distinct table
+        offsets = {}
+        compiled = {}
+        for tm in machines:
+            if id(tm.states) not in offsets:
+                c = compiled[id(tm.states)] = tm.compile()
+                offsets[id(tm.states)] = len(self.state_names)
+                self.state_names.extend(c.state_names)
+                for name in c.symbol_names:
+                    self.symbol_id(name)
+            for name in tm.symbol_names:
+                self.symbol_id(name)
+        nsym = self.nsym = len(self.symbol_names)
+        size = len(self.state_names) * nsym
+        self.write = np.zeros(size, np.uint8)
+        self.move = np.zeros(size, np.int64)
+        self.nextstate = np.zeros(size, np.int64)
+        self.defined = np.zeros(size, bool)
+        for key, c in compiled.items():
+            offset = offsets[key]
+            for i, transition in enumerate(c.table):
+                if transition is not None:
+                    state, code = divmod(i, c.nsym)
+                    j = (offset + state) * nsym + self.symbol_ids[c.symbol_names[code]]
+                    self.write[j] = self.symbol_ids[c.symbol_names[transition[0]]]
+                    self.move[j] = transition[1]
+                    self.nextstate[j] = offset + transition[2]
+                    self.defined[j] = True
+
+        lanes = len(machines)
+        self.state = np.zeros(lanes, np.int64)
+        self.steps = np.zeros(lanes, np.int64)
+        self.running = np.zeros(lanes, bool)
+        self.fill = np.zeros(lanes, np.uint8)
+        # the initial tapes, as (first cell, codes) relative to the head
+        tapes = []
+        for lane, tm in enumerate(machines):
+            c = compiled[id(tm.states)]
+            if tm.statename in c.state_ids:
+                self.state[lane] = offsets[id(tm.states)] + c.state_ids[tm.statename]
+                self.running[lane] = True
+            self.fill[lane] = self.symbol_ids[tm.symbol_names[tm.tape.fill]]
+            first, last = tm.tape_bounds()
+            head = tm.tape.head
+            codes = tm.tape.get_range(head + first, head + last + 1)
+            tapes.append((first, bytes(self.symbol_ids[tm.symbol_names[code]] for code in codes)))
+        reach = max([max(-first, len(codes) + first) for first, codes in tapes] + [0]) + margin
+        self.tape = np.empty((lanes, 2 * reach), np.uint8)
+        self.tape[:] = self.fill[:, None]
+        self.origin = reach # column of cell 0 relative to the initial heads
+        for lane, (first, codes) in enumerate(tapes):
+            start = self.origin + first
+            self.tape[lane, start:start + len(codes)] = np.frombuffer(codes, np.uint8)
+        self.head = np.full(lanes, self.origin, np.int64)
+
+    def symbol_id(self, name):
+        if name not in self.symbol_ids:
+            if len(self.symbol_names) == 256:
+                raise ValueError("too many symbols")
+            self.symbol_ids[name] = len(self.symbol_names)
+            self.symbol_names.append(name)
+        return self.symbol_ids[name]
+
+    def grow(self):
+        """Doubles the tape width, keeping the heads in the middle part"""
+        lanes, width = self.tape.shape
+        tape = np.empty((lanes, 2 * width), np.uint8)
+        tape[:] = self.fill[:, None]
+        tape[:, width // 2:width // 2 + width] = self.tape
+        self.tape = tape
+        self.head += width // 2
+        self.origin += width // 2
+
+    def run(self, max_steps):
+        """Runs every lane max_steps steps or until it has no transition"""
+        nsym = self.nsym
+        lanes = np.nonzero(self.running)[0]
+        for _ in range(max_steps):
+            if not len(lanes):
+                break
+            head = self.head[lanes]
+            index = self.state[lanes] * nsym + self.tape[lanes, head]
+            defined = self.defined[index]
+            if not defined.all():
+                self.running[lanes[~defined]] = False
+                lanes = lanes[defined]
+                head = head[defined]
+                index = index[defined]
+            self.tape[lanes, head] = self.write[index]
+            head += self.move[index]
+            self.head[lanes] = head
+            self.state[lanes] = self.nextstate[index]
+            self.steps[lanes] += 1
+            if len(head) and (head.min() == 0 or head.max() == self.tape.shape[1] - 1):
+                self.grow()
+
+    def store(self):
+        """Writes the state, step count and tape of every lane back into its machine"""
+        for lane, tm in enumerate(self.machines):
+            codes = bytes(tm.symbol_code(name) for name in self.symbol_names)
+            row = self.tape[lane].tobytes().translate(codes.ljust(256, b"\0"))
+            head = tm.tape.head
+            tm.tape.load(head - self.origin, row, head + int(self.head[lane]) - self.origin)
+            tm.tape.trim()
+            tm.statename = self.state_names[self.state[lane]]
+            tm.stepcount += int(self.steps[lane])
+
+    @classmethod
+    def from_tapes(cls, tm, specs):
+        """A batch of tm run from each of a list of initial tapes, given as
+        the arguments of "#! write" ([symbols] or [index, symbols])"""
+        machines = []
+        for spec in specs:
+            lane = TuringMachine(trace_depth=0)
+            lane.states = tm.states
+            lane.symbol_names = tm.symbol_names
+            lane.symbol_ids = tm.symbol_ids
+            lane.start = lane.statename = tm.statename
+            lane.fill = tm.fill
+            lane.write_tape_spec(spec)
+            machines.append(lane)
+        return cls(machines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run many copies of a Turing machine in lockstep with NumPy")
+    parser.add_argument("TM_File", help="Turing Machine file")
+    parser.add_argument("--lanes", type=int, default=1000, help="machines run at once (default 1000)")
+    parser.add_argument("--steps", type=int, default=10000, help="steps to run (default 10000)")
+    parser.add_argument("--tapes", metavar="FILE",
+                        help="initial tapes, one per line as the arguments of #! write (default: the file's own)")
+    parser.add_argument("--random", type=int, metavar="N",
+                        help="start each lane on a random word of N of the machine's symbols")
+    args = parser.parse_args()
+
+    tm = TuringMachine(trace_depth=0)
+    tm.load(args.TM_File)
+    tm.statename = tm.start
+    if args.tapes:
+        with open(args.tapes) as f:
+            specs = [line.split() for line in f if line.strip()]
+        specs = (specs * (args.lanes // len(specs) + 1))[:args.lanes]
+    elif args.random:
+        symbols = sorted(tm.symbols)
+        specs = [["".join(random.choice(symbols) for _ in range(args.random))] for _ in range(args.lanes)]
+    else:
+        specs = None
+
+    if specs is None:
+        # copies of the machine as loaded
+        machines = [tm]
+        for _ in range(args.lanes - 1):
+            lane = TuringMachine(trace_depth=0)
+            lane.load(args.TM_File, keep_source=False)
+            lane.statename = lane.start
+            machines.append(lane)
+        batch = LockstepBatch(machines)
+    else:
+        batch = LockstepBatch.from_tapes(tm, specs)
+
+    reference = TuringMachine(trace_depth=0)
+    reference.load(args.TM_File)
+    reference.statename = reference.start
+    if specs is not None:
+        reference.reset_tape()
+        reference.write_tape_spec(specs[-1])
+
+    # step() on the last lane in a Python loop as the reference
+    steps = 0
+    begin = time.perf_counter()
+    while steps < args.steps and reference.step():
+        steps += 1
+    elapsed = time.perf_counter() - begin
+    print("  {:<10} {:>12} steps {:>8.3f}s {:>14,.0f} steps/s".format(
+        "step()", reference.stepcount, elapsed, reference.stepcount / elapsed if elapsed else 0))
+
+    begin = time.perf_counter()
+    batch.run(args.steps)
+    elapsed = time.perf_counter() - begin
+    total = int(batch.steps.sum())
+    batch.store()
+    lane = batch.machines[-1]
+    same = (lane.stepcount, lane.statename, lane.left, lane.right, lane.symbol) == \
+        (reference.stepcount, reference.statename, reference.left, reference.right, reference.symbol)
+    print("  {:<10} {:>12} steps {:>8.3f}s {:>14,.0f} steps/s in {} lanes, {} still running{}".format(
+        "lockstep", total, elapsed, total / elapsed if elapsed else 0, len(batch.machines),
+        int(batch.running.sum()), "" if same else "  MISMATCH"))